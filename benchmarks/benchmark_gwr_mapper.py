@@ -0,0 +1,166 @@
+"""
+Benchmarks each stage of the GWR Mapper on synthetic data and writes the wall time and peak memory of every stage to a
+JSON report. Runs offline with a stubbed locator and a synthetic construction standards table, so neither CEA
+databases nor the real GWR register are needed.
+
+Usage: python benchmarks/benchmark_gwr_mapper.py --scale small --output benchmark.json
+"""
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import geopandas as gpd
+import pandas as pd
+from shapely.geometry import Point
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from synthetic_data import generate_scenario
+
+from cea_osm_gwr_mapper.gwr_mapping import match_gwr_to_buildings, reduce_building_properties, \
+    fill_missing_properties, generate_typology
+from cea_osm_gwr_mapper.gwr_utils import read_gwr, filter_gwr_by_bounds, gwr_to_cea_code, fill_building_type, \
+    LV95_PROJECTION
+
+__author__ = "Reynold Mok"
+__copyright__ = "Copyright 2020, Architecture and Building Systems - ETH Zurich"
+__credits__ = ["Reynold Mok"]
+__license__ = "MIT"
+__version__ = "0.1"
+__maintainer__ = "Reynold Mok"
+__email__ = "cea@arch.ethz.ch"
+__status__ = "Production"
+
+# Number of zone buildings and GWR rows of each scale
+SCALES = {
+    'small': (1000, 100000),
+    'medium': (10000, 1000000),
+    'large': (100000, 3000000),
+}
+
+STANDARD_DEFINITION = pd.DataFrame({'STANDARD': ['STANDARD1', 'STANDARD2', 'STANDARD3', 'STANDARD4'],
+                                    'YEAR_START': [0, 1920, 1971, 2001],
+                                    'YEAR_END': [1919, 1970, 2000, 2100]})
+
+
+class BenchmarkLocator(object):
+    """
+    Stands in for ``cea.inputlocator.InputLocator`` with the paths of a synthetic scenario.
+    """
+    def __init__(self, scenario):
+        self.scenario = scenario
+
+    def get_zone_geometry(self):
+        return os.path.join(self.scenario, 'inputs', 'building-geometry', 'zone.shp')
+
+
+def run_stage(results, name, func, *args, **kwargs):
+    """
+    Runs ``func`` and records its wall time and peak traced memory in ``results``.
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    rows = len(result) if hasattr(result, '__len__') else None
+    results.setdefault(name, []).append({'seconds': elapsed, 'peak_memory_mb': peak / 1024 ** 2, 'rows': rows})
+    print('  {:<28} {:>9.3f} s {:>10.1f} MiB {:>10} rows'.format(name, elapsed, peak / 1024 ** 2, rows))
+    return result
+
+
+def benchmark(gwr_path, zone_gdf, locator, repeat=1):
+    """
+    Runs every stage of the GWR Mapper ``repeat`` times and returns the measurements of each stage.
+    """
+    results = {}
+    for i in range(repeat):
+        print('Run {}/{}'.format(i + 1, repeat))
+        zone_gdf.to_file(locator.get_zone_geometry())
+        reprojected_zone_gdf = run_stage(results, 'read_zone', gpd.read_file, locator.get_zone_geometry())
+        reprojected_zone_gdf = reprojected_zone_gdf.to_crs(LV95_PROJECTION)
+
+        gwr_df = run_stage(results, 'read_gwr', read_gwr, gwr_path, cache='bypass')
+        gwr_df = run_stage(results, 'filter_gwr_by_bounds', filter_gwr_by_bounds, gwr_df,
+                           *reprojected_zone_gdf['geometry'].total_bounds)
+
+        def translate(df):
+            return fill_building_type(gwr_to_cea_code(df))[0]
+        gwr_df = run_stage(results, 'gwr_to_cea_code', translate, gwr_df.copy())
+
+        def to_geodataframe(df):
+            coord_points = [Point(x, y) for x, y in zip(df['e_coordinate'], df['n_coordinate'])]
+            return gpd.GeoDataFrame(df, geometry=coord_points, crs=LV95_PROJECTION)
+        gwr_gdf = run_stage(results, 'create_gwr_points', to_geodataframe, gwr_df)
+
+        zone_geometries = reprojected_zone_gdf[['Name', 'geometry']].reset_index(drop=True)
+        matched_df = run_stage(results, 'match_gwr_to_buildings', match_gwr_to_buildings, zone_geometries, gwr_gdf)
+        properties_df = run_stage(results, 'reduce_building_properties', reduce_building_properties, matched_df)
+
+        properties_df = properties_df.set_index('Name').reindex(zone_geometries['Name'])
+        properties_df = run_stage(results, 'fill_missing_properties', fill_missing_properties, properties_df)
+        run_stage(results, 'generate_typology', generate_typology, properties_df.reset_index(), STANDARD_DEFINITION)
+
+    return results
+
+
+def summarize(results):
+    """
+    Returns the best wall time and largest peak memory of each stage over all runs.
+    """
+    return {name: {'seconds': min(run['seconds'] for run in runs),
+                   'peak_memory_mb': max(run['peak_memory_mb'] for run in runs),
+                   'rows': runs[-1]['rows']}
+            for name, runs in results.items()}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small',
+                        help='Preset number of zone buildings and GWR rows')
+    parser.add_argument('--buildings', type=int, help='Number of zone buildings, overrides the scale')
+    parser.add_argument('--gwr-rows', type=int, help='Number of GWR rows, overrides the scale')
+    parser.add_argument('--repeat', type=int, default=1, help='Number of times to run each stage')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic data')
+    parser.add_argument('--work-dir', default=os.path.join(tempfile.gettempdir(), 'gwr-mapper-benchmark'),
+                        help='Directory to store the synthetic data in, reused between runs')
+    parser.add_argument('--output', default='benchmark.json', help='Path of the JSON report')
+    args = parser.parse_args(argv)
+
+    number_of_buildings, number_of_rows = SCALES[args.scale]
+    number_of_buildings = args.buildings or number_of_buildings
+    number_of_rows = args.gwr_rows or number_of_rows
+
+    gwr_path, zone_gdf = generate_scenario(args.work_dir, number_of_buildings, number_of_rows, args.seed)
+    locator = BenchmarkLocator(os.path.join(args.work_dir, 'scenario-{}'.format(number_of_buildings)))
+    if not os.path.exists(os.path.dirname(locator.get_zone_geometry())):
+        os.makedirs(os.path.dirname(locator.get_zone_geometry()))
+
+    print('Benchmarking {} buildings with {} GWR rows'.format(number_of_buildings, number_of_rows))
+    results = benchmark(gwr_path, zone_gdf, locator, args.repeat)
+
+    report = {'buildings': number_of_buildings,
+              'gwr_rows': number_of_rows,
+              'repeat': args.repeat,
+              'seed': args.seed,
+              'python': platform.python_version(),
+              'pandas': pd.__version__,
+              'geopandas': gpd.__version__,
+              'stages': summarize(results),
+              'runs': results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Benchmark report written to: {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
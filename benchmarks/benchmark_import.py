@@ -0,0 +1,99 @@
+"""
+Measures how much registering the GWR Mapper plugin adds to the startup of CEA. Imports the plugin module in fresh
+interpreters, compares the time with importing ``cea.plugin`` alone and lists the heavy modules pulled in by the import.
+
+Usage: python benchmarks/benchmark_import.py --repeat 5 --output benchmark-import.json
+"""
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import platform
+import subprocess
+import sys
+
+__author__ = "Reynold Mok"
+__copyright__ = "Copyright 2020, Architecture and Building Systems - ETH Zurich"
+__credits__ = ["Reynold Mok"]
+__license__ = "MIT"
+__version__ = "0.1"
+__maintainer__ = "Reynold Mok"
+__email__ = "cea@arch.ethz.ch"
+__status__ = "Production"
+
+BASELINE_MODULE = 'cea.plugin'
+PLUGIN_MODULE = 'cea_osm_gwr_mapper.gwr_mapper'
+
+# Modules that should only be imported when the GWR Mapper runs
+HEAVY_MODULES = ['pandas', 'geopandas', 'shapely', 'pyproj', 'fiona', 'cea.datamanagement.archetypes_mapper']
+
+IMPORT_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{'seconds': seconds, 'modules': sorted(sys.modules)}}))
+"""
+
+
+def time_import(module):
+    """
+    Imports ``module`` in a fresh interpreter and returns the time it took and the modules loaded afterwards.
+    """
+    output = subprocess.check_output([sys.executable, '-c', IMPORT_SCRIPT.format(module=module)])
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def get_slowest_imports(module, count=10):
+    """
+    Returns the ``count`` modules with the largest cumulative import time in microseconds when importing ``module``,
+    as reported by ``python -X importtime``.
+    """
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import {}'.format(module)],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    imports = []
+    for line in process.stderr.decode().splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        imports.append((name.strip(), int(cumulative)))
+    return sorted(imports, key=lambda item: item[1], reverse=True)[:count]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5, help='Number of fresh interpreters to time each import in')
+    parser.add_argument('--output', default='benchmark-import.json', help='Path of the JSON report')
+    args = parser.parse_args(argv)
+
+    baseline_runs = [time_import(BASELINE_MODULE) for _ in range(args.repeat)]
+    plugin_runs = [time_import(PLUGIN_MODULE) for _ in range(args.repeat)]
+    baseline_seconds = min(run['seconds'] for run in baseline_runs)
+    plugin_seconds = min(run['seconds'] for run in plugin_runs)
+
+    added_modules = sorted(set(plugin_runs[-1]['modules']) - set(baseline_runs[-1]['modules']))
+    heavy_modules = [module for module in HEAVY_MODULES if module in plugin_runs[-1]['modules']]
+
+    print('Importing {}: {:.3f} s'.format(BASELINE_MODULE, baseline_seconds))
+    print('Importing {}: {:.3f} s'.format(PLUGIN_MODULE, plugin_seconds))
+    print('Added by the plugin: {:.3f} s, {} modules'.format(plugin_seconds - baseline_seconds, len(added_modules)))
+    print('Heavy modules imported: {}'.format(', '.join(heavy_modules) or 'none'))
+
+    report = {'repeat': args.repeat,
+              'python': platform.python_version(),
+              'baseline_module': BASELINE_MODULE,
+              'baseline_seconds': baseline_seconds,
+              'plugin_module': PLUGIN_MODULE,
+              'plugin_seconds': plugin_seconds,
+              'added_seconds': plugin_seconds - baseline_seconds,
+              'added_modules': added_modules,
+              'heavy_modules': heavy_modules,
+              'slowest_imports_us': get_slowest_imports(PLUGIN_MODULE)}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Benchmark report written to: {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
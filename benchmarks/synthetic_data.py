@@ -0,0 +1,138 @@
+"""
+Generates synthetic GWR exports and zone building geometries to benchmark the GWR Mapper without the real register.
+
+The zone is a regular grid of rectangular buildings. Every building gets a few GWR properties within its footprint, some
+of them get none, and the remaining GWR rows are spread over the whole of Switzerland, so that the zone only covers a
+small part of the register like in a real run.
+"""
+from __future__ import division
+from __future__ import print_function
+
+import os
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+from shapely.geometry import box
+
+from cea_osm_gwr_mapper.gwr_utils import GWR_HEADERS, BUILDING_TYPE, HEATING_TECH, HOT_WATER_TECH, \
+    ENERGY_HEAT_SOURCE, LV95_PROJECTION
+
+__author__ = "Reynold Mok"
+__copyright__ = "Copyright 2020, Architecture and Building Systems - ETH Zurich"
+__credits__ = ["Reynold Mok"]
+__license__ = "MIT"
+__version__ = "0.1"
+__maintainer__ = "Reynold Mok"
+__email__ = "cea@arch.ethz.ch"
+__status__ = "Production"
+
+SWITZERLAND_BOUNDS = (2485000.0, 1075000.0, 2834000.0, 1296000.0)  # LV95
+ZONE_ORIGIN = (2680000.0, 1245000.0)
+BUILDING_SIZE = 20.0
+BUILDING_SPACING = 30.0
+PROPERTIES_PER_BUILDING = 3  # Maximum number of GWR properties within a zone building
+WRITE_CHUNK_SIZE = 200000
+
+
+def generate_zone(number_of_buildings):
+    """
+    Returns ``number_of_buildings`` square buildings on a regular grid in the zone.shp layout of CEA.
+    """
+    side = int(np.ceil(np.sqrt(number_of_buildings)))
+    positions = np.arange(number_of_buildings)
+    x = ZONE_ORIGIN[0] + (positions % side) * BUILDING_SPACING
+    y = ZONE_ORIGIN[1] + (positions // side) * BUILDING_SPACING
+
+    return gpd.GeoDataFrame({'Name': ['B{:06d}'.format(i) for i in positions],
+                             'floors_ag': 3,
+                             'floors_bg': 1,
+                             'height_ag': 9.0,
+                             'height_bg': 3.0},
+                            geometry=[box(x0, y0, x0 + BUILDING_SIZE, y0 + BUILDING_SIZE) for x0, y0 in zip(x, y)],
+                            crs=LV95_PROJECTION)
+
+
+def generate_gwr_rows(zone_gdf, number_of_rows, rng):
+    """
+    Returns the coordinates of ``number_of_rows`` GWR properties, those in zone buildings first.
+    """
+    minx, miny, _, _ = zone_gdf['geometry'].bounds.values.T
+    properties_per_building = rng.integers(0, PROPERTIES_PER_BUILDING + 1, len(zone_gdf))
+    buildings = np.repeat(np.arange(len(zone_gdf)), properties_per_building)[:number_of_rows]
+
+    # Keep points off the building edges so that they are strictly within the building
+    offsets = rng.uniform(1.0, BUILDING_SIZE - 1.0, (len(buildings), 2))
+    number_outside = number_of_rows - len(buildings)
+    e_coords = np.concatenate([minx[buildings] + offsets[:, 0],
+                               rng.uniform(SWITZERLAND_BOUNDS[0], SWITZERLAND_BOUNDS[2], number_outside)])
+    n_coords = np.concatenate([miny[buildings] + offsets[:, 1],
+                               rng.uniform(SWITZERLAND_BOUNDS[1], SWITZERLAND_BOUNDS[3], number_outside)])
+
+    return np.round(e_coords, 3), np.round(n_coords, 3)
+
+
+def generate_gwr_chunk(federal_ids, e_coords, n_coords, rng):
+    """
+    Returns GWR rows in the layout of ``GWR_HEADERS`` with random properties at the given coordinates.
+    """
+    size = len(federal_ids)
+    df = pd.DataFrame(index=np.arange(size), columns=GWR_HEADERS)
+
+    df['federal_id'] = federal_ids
+    df['canton'] = rng.choice(['ZH', 'BE', 'VD', 'GE', 'TI'], size)
+    df['district_number'] = rng.integers(1, 300, size)
+    df['district_name'] = rng.choice(['Zurich', 'Bern', 'Lausanne', 'Geneve', 'Lugano'], size)
+    df['e_coordinate'] = np.where(rng.random(size) < 0.01, np.nan, e_coords)
+    df['n_coordinate'] = n_coords
+    df['building_category'] = rng.choice([1020, 1030, 1040, 1060], size)
+    df['building_class'] = rng.choice(list(BUILDING_TYPE) + [1110, 1275], size)
+    df['building_status'] = rng.choice([1004, 1004, 1004, 1004, 1007], size)
+    df['construction_year'] = np.where(rng.random(size) < 0.1, np.nan, rng.integers(1800, 2021, size))
+    df['building_area'] = np.where(rng.random(size) < 0.1, np.nan, rng.integers(30, 2000, size))
+    df['number_floors'] = np.where(rng.random(size) < 0.1, np.nan, rng.integers(1, 10, size))
+    df['heating_tech_1'] = rng.choice(list(HEATING_TECH), size)
+    df['heating_source_1'] = rng.choice(list(ENERGY_HEAT_SOURCE), size)
+    df['hot_water_tech_1'] = rng.choice(list(HOT_WATER_TECH), size)
+    df['hot_water_source_1'] = rng.choice(list(ENERGY_HEAT_SOURCE), size)
+
+    return df
+
+
+def generate_gwr(gwr_path, zone_gdf, number_of_rows, seed=0):
+    """
+    Writes a tab-separated GWR export without header with ``number_of_rows`` properties to ``gwr_path``, in chunks so
+    that large registers can be generated without holding them in memory.
+    """
+    rng = np.random.default_rng(seed)
+    e_coords, n_coords = generate_gwr_rows(zone_gdf, number_of_rows, rng)
+
+    # Shuffle so that the properties of the zone are spread over the whole file
+    order = rng.permutation(number_of_rows)
+    e_coords = e_coords[order]
+    n_coords = n_coords[order]
+
+    with open(gwr_path, 'w') as f:
+        for start in range(0, number_of_rows, WRITE_CHUNK_SIZE):
+            stop = min(start + WRITE_CHUNK_SIZE, number_of_rows)
+            df = generate_gwr_chunk(np.arange(start, stop) + 100000, e_coords[start:stop], n_coords[start:stop], rng)
+            df.to_csv(f, sep='\t', header=False, index=False)
+
+
+def generate_scenario(work_dir, number_of_buildings, number_of_rows, seed=0):
+    """
+    Generates the zone and GWR export of the given size in ``work_dir``, reusing the files of a previous run with the
+    same parameters. Returns the path of the GWR file and the zone.
+    """
+    gwr_path = os.path.join(work_dir, 'gwr-{}-{}-{}.txt'.format(number_of_buildings, number_of_rows, seed))
+    zone_gdf = generate_zone(number_of_buildings)
+
+    if not os.path.exists(gwr_path):
+        print('Generating synthetic GWR file with {} rows: {}'.format(number_of_rows, gwr_path))
+        if not os.path.exists(work_dir):
+            os.makedirs(work_dir)
+        tmp_path = gwr_path + '.tmp'
+        generate_gwr(tmp_path, zone_gdf, number_of_rows, seed)
+        os.rename(tmp_path, gwr_path)
+
+    return gwr_path, zone_gdf
@@ -0,0 +1,150 @@
+"""
+Maps the buildings of many scenarios against a single load of the GWR data. The GWR data covering all zones is read,
+translated and turned into points once, and every scenario is then mapped against its part of it, spread over a pool of
+processes.
+"""
+from __future__ import division
+from __future__ import print_function
+
+import glob
+import os
+import time
+
+import cea.config
+import cea.inputlocator
+import geopandas as gpd
+from cea.utilities.parallel import vectorize
+
+from cea_osm_gwr_mapper.gwr_instrumentation import RunReport, configure_logging, logger
+from cea_osm_gwr_mapper.gwr_mapping import gwr_mapper, load_gwr_data, select_gwr_data_files, get_union_bounds
+from cea_osm_gwr_mapper.gwr_utils import LV95_PROJECTION, filter_gwr_by_bounds
+
+__author__ = "Reynold Mok"
+__copyright__ = "Copyright 2020, Architecture and Building Systems - ETH Zurich"
+__credits__ = ["Reynold Mok"]
+__license__ = "MIT"
+__version__ = "0.1"
+__maintainer__ = "Reynold Mok"
+__email__ = "cea@arch.ethz.ch"
+__status__ = "Production"
+
+
+def get_scenarios(scenarios):
+    """
+    Returns the scenario folders of ``scenarios``, a list of scenario folders or glob patterns of scenario folders.
+    """
+    paths = []
+    for scenario in scenarios:
+        matches = sorted(glob.glob(scenario)) if glob.has_magic(scenario) else [scenario]
+        paths.extend(os.path.abspath(path) for path in matches if os.path.isdir(path))
+    # Keep the first occurrence of scenarios matched more than once
+    return sorted(set(paths), key=paths.index)
+
+
+def get_zone_bounds(config, locator):
+    """
+    Returns the bounds of the zone of the scenario of ``locator`` in LV95 coordinates, including the surroundings if
+    they are mapped as well.
+    """
+    paths = [locator.get_zone_geometry()]
+    if config.gwr_mapper.map_surroundings and os.path.exists(locator.get_surroundings_geometry()):
+        paths.append(locator.get_surroundings_geometry())
+    return get_union_bounds([gpd.read_file(path).to_crs(LV95_PROJECTION)['geometry'].total_bounds for path in paths])
+
+
+def get_scenario_gwr_data(config, gwr_data, bounds):
+    """
+    Returns the part of ``gwr_data`` within ``bounds`` of the zone of a scenario, with the GWR files covering the zone.
+    The building type of unknown GWR building classes is only filled in from this part when the scenario is mapped, so
+    that the scenario is mapped as in a single run and shares its incremental state.
+    """
+    return {'gwr_paths': select_gwr_data_files(config, bounds),
+            'gwr_gdf': filter_gwr_by_bounds(gwr_data['gwr_gdf'], *bounds)}
+
+
+def map_scenario(config, scenario, gwr_data):
+    """
+    Maps the zone of ``scenario`` against ``gwr_data``. Returns the result of the scenario instead of raising, so that a
+    failing scenario does not stop the others.
+    """
+    start = time.time()
+    try:
+        report = gwr_mapper(config, cea.inputlocator.InputLocator(scenario, config.plugins), gwr_data)
+        return {'scenario': scenario, 'success': True, 'seconds': time.time() - start, 'stages': len(report.stages)}
+    except Exception as e:
+        return {'scenario': scenario, 'success': False, 'seconds': time.time() - start,
+                'error': '{}: {}'.format(type(e).__name__, e)}
+
+
+def gwr_mapper_batch(config, scenarios):
+    """
+    Maps the zone buildings of all ``scenarios`` against one load of the GWR data and returns the result of each
+    scenario.
+    """
+    results = []
+    zone_bounds = {}
+    for scenario in scenarios:
+        try:
+            zone_bounds[scenario] = get_zone_bounds(config, cea.inputlocator.InputLocator(scenario, config.plugins))
+        except Exception as e:
+            results.append({'scenario': scenario, 'success': False, 'seconds': 0.0,
+                            'error': 'Unable to read zone: {}: {}'.format(type(e).__name__, e)})
+    if not zone_bounds:
+        return results
+
+    # Load the GWR data covering the zones of all scenarios once
+    bounds = get_union_bounds(list(zone_bounds.values()))
+    report = RunReport(config.gwr_mapper.max_memory)
+    gwr_data = load_gwr_data(config, select_gwr_data_files(config, bounds), bounds, report)
+
+    # Every scenario only gets the GWR points within its zone, so little data is sent to the worker processes
+    mapped_scenarios = []
+    scenario_gwr_data = []
+    for scenario, scenario_bounds in zone_bounds.items():
+        try:
+            scenario_gwr_data.append(get_scenario_gwr_data(config, gwr_data, scenario_bounds))
+            mapped_scenarios.append(scenario)
+        except ValueError as e:
+            results.append({'scenario': scenario, 'success': False, 'seconds': 0.0, 'error': str(e)})
+    if not mapped_scenarios:
+        return results
+
+    processes = min(config.get_number_of_processes(), len(mapped_scenarios))
+    if processes > 1:
+        # Scenarios are mapped in parallel, so each of them is mapped in a single process
+        config.multiprocessing = False
+    logger.info('Mapping {} scenarios'.format(len(mapped_scenarios)))
+    results.extend(vectorize(map_scenario, processes)([config] * len(mapped_scenarios), mapped_scenarios,
+                                                      scenario_gwr_data))
+
+    return sorted(results, key=lambda result: scenarios.index(result['scenario']))
+
+
+def main(config):
+    """
+    Maps the zone buildings of every scenario in ``gwr-mapper-batch:scenarios`` against a single load of the GWR data.
+
+    :param cea.config.Configuration config: The configuration for this script, restricted to the scripts parameters.
+    :return: None
+    """
+    configure_logging()
+    scenarios = get_scenarios(config.gwr_mapper_batch.scenarios)
+    if not scenarios:
+        raise ValueError('No scenarios found in {}'.format(config.gwr_mapper_batch.scenarios))
+
+    results = gwr_mapper_batch(config, scenarios)
+
+    for result in results:
+        if result['success']:
+            logger.info('Mapped {} in {:.1f} s'.format(result['scenario'], result['seconds']))
+        else:
+            logger.error('Failed to map {}: {}'.format(result['scenario'], result['error']))
+
+    failed = [result['scenario'] for result in results if not result['success']]
+    logger.info('Mapped {} of {} scenarios'.format(len(results) - len(failed), len(results)))
+    if failed:
+        raise RuntimeError('Failed to map {} scenarios: {}'.format(len(failed), ', '.join(failed)))
+
+
+if __name__ == '__main__':
+    main(cea.config.Configuration())
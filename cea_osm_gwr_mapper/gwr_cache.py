@@ -0,0 +1,303 @@
+"""
+Persistent columnar cache of the parsed GWR register. Each column is stored as a numpy ``.npy`` file (string columns as
+categorical codes) together with a ``meta.json`` holding the key of the GWR file it was built from.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+CACHE_VERSION = 2
+CACHE_META_FILE = 'meta.json'
+HASH_SAMPLE_SIZE = 1024 * 1024
+COPY_BLOCK_ROWS = 1024 * 1024
+
+
+def get_cache_path(gwr_path, cache_dir=None):
+    """
+    Returns the cache directory of ``gwr_path``. The cache is stored next to the GWR file unless ``cache_dir`` is given.
+    """
+    gwr_path = os.path.abspath(gwr_path)
+    if not cache_dir:
+        return gwr_path + '.cache'
+    path_hash = hashlib.sha1(gwr_path.encode('utf-8')).hexdigest()[:12]
+    return os.path.join(cache_dir, '{}-{}.cache'.format(os.path.basename(gwr_path), path_hash))
+
+
+def get_cache_key(gwr_path):
+    """
+    Returns the key identifying the contents of the GWR file. The content hash only covers the first and last MiB of the
+    file so that checking the key stays cheap for the national register.
+    """
+    stat = os.stat(gwr_path)
+    content_hash = hashlib.sha1()
+    with open(gwr_path, 'rb') as f:
+        content_hash.update(f.read(HASH_SAMPLE_SIZE))
+        if stat.st_size > HASH_SAMPLE_SIZE:
+            f.seek(max(stat.st_size - HASH_SAMPLE_SIZE, HASH_SAMPLE_SIZE))
+            content_hash.update(f.read())
+
+    return {'version': CACHE_VERSION,
+            'path': os.path.abspath(gwr_path),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'content_hash': content_hash.hexdigest()}
+
+
+def read_cache(cache_path, key, bounds=None):
+    """
+    Returns the cached dataframe stored in ``cache_path``, or None if there is no cache, it was built from a different
+    version of the GWR file or it was replaced while reading. The columns are memory-mapped, so only properties within
+    ``bounds`` (minx, miny, maxx, maxy) are loaded into memory if given.
+    """
+    meta = read_meta(cache_path)
+    if meta is None or meta['key'] != key:
+        return None
+
+    try:
+        rows = slice(None)
+        if bounds is not None:
+            minx, miny, maxx, maxy = bounds
+            e_coords = load_column(cache_path, 'e_coordinate')
+            n_coords = load_column(cache_path, 'n_coordinate')
+            rows = (minx <= e_coords) & (e_coords <= maxx) & (miny <= n_coords) & (n_coords <= maxy)
+
+        return read_columns(cache_path, meta, rows)
+    except (IOError, OSError, ValueError):
+        # Another run replaced the cache after its metadata was read
+        return None
+
+
+def write_cache(df, cache_path, key):
+    """
+    Stores ``df`` in ``cache_path``, replacing any existing cache.
+    """
+    write_columns(df, cache_path, {'key': key})
+
+
+def read_meta(path):
+    """
+    Returns the metadata of the columnar store in ``path``, or None if there is none.
+    """
+    try:
+        with open(os.path.join(path, CACHE_META_FILE)) as f:
+            return json.load(f)
+    except (IOError, OSError):
+        return None
+
+
+def load_column(path, column):
+    """
+    Returns the memory-mapped values of ``column`` in the columnar store in ``path``.
+    """
+    return np.load(os.path.join(path, '{}.npy'.format(column)), mmap_mode='r')
+
+
+def read_columns(path, meta, rows=slice(None)):
+    """
+    Returns ``rows`` (a slice, boolean mask or positions) of the columnar store in ``path`` as a dataframe.
+    """
+    columns = {}
+    for column in meta['columns']:
+        values = np.array(load_column(path, column)[rows])
+        if column in meta['categories']:
+            values = pd.Categorical.from_codes(values, meta['categories'][column])
+        columns[column] = values
+
+    return pd.DataFrame(columns, columns=meta['columns']).set_index(meta['index'])
+
+
+def write_columns(df, path, meta):
+    """
+    Stores ``df`` column by column in ``path`` together with ``meta``, replacing any existing store.
+    """
+    writer = ColumnWriter(path, meta)
+    writer.append(df)
+    writer.close()
+    if writer.error is not None:
+        raise writer.error
+
+
+def open_cache_writer(cache_path, key):
+    """
+    Returns a ``ColumnWriter`` building the cache in ``cache_path`` chunk by chunk.
+    """
+    return ColumnWriter(cache_path, {'key': key})
+
+
+class ColumnWriter(object):
+    """
+    Writes a columnar store chunk by chunk, so that stores larger than memory can be built. The chunks are appended to
+    raw column files in a temporary directory of its own, that ``close`` turns into the ``.npy`` files of the store
+    before replacing the store in ``path``. Runs sharing a store thus do not write over each other and readers never
+    see a partly written store.
+
+    An ``IOError`` or ``OSError`` while writing is kept in ``error`` and discards the store, so that the caller can
+    carry on without it.
+    """
+
+    def __init__(self, path, meta):
+        self.path = path
+        self.meta = meta
+        self.tmp_path = None
+        self.error = None
+        self.index = None
+        self.columns = None
+        self.dtypes = {}
+        self.categories = {}
+        self.saved_columns = set()
+        self.rows = 0
+        try:
+            parent = os.path.dirname(os.path.abspath(path))
+            if not os.path.exists(parent):
+                os.makedirs(parent)
+            self.tmp_path = tempfile.mkdtemp(prefix=os.path.basename(path) + '.', suffix='.tmp', dir=parent)
+        except (IOError, OSError) as e:
+            self.fail(e)
+
+    def append(self, df):
+        """
+        Appends the rows of ``df`` to the store. Every chunk must have the same index and columns.
+        """
+        if self.error is not None:
+            return
+        df = df.reset_index()
+        if self.columns is None:
+            self.index = df.columns[0]
+            self.columns = df.columns.tolist()
+        try:
+            for column in self.columns:
+                values = df[column]
+                if values.dtype == object or isinstance(values.dtype, pd.CategoricalDtype):
+                    values = self.get_codes(column, values)
+                values = np.asarray(values).astype(self.dtypes.setdefault(column, values.dtype), copy=False)
+                with open(self.get_raw_path(column), 'ab') as f:
+                    values.tofile(f)
+            self.rows += len(df)
+        except (IOError, OSError) as e:
+            self.fail(e)
+
+    def set_column(self, column, values):
+        """
+        Replaces all values of ``column`` with ``values``, e.g. to fill in values only known once all chunks are read.
+        """
+        if self.error is not None:
+            return
+        try:
+            np.save(os.path.join(self.tmp_path, '{}.npy'.format(column)), np.asarray(values))
+            self.saved_columns.add(column)
+            if os.path.exists(self.get_raw_path(column)):
+                os.remove(self.get_raw_path(column))
+        except (IOError, OSError) as e:
+            self.fail(e)
+
+    def close(self):
+        """
+        Completes the store, with ``meta.json`` written last, and puts it in place of the store in ``path``.
+        """
+        if self.error is not None:
+            return
+        try:
+            categories = {}
+            for column in self.columns:
+                if column in self.categories:
+                    categories[column] = self.save_codes(column)
+                elif column not in self.saved_columns:
+                    self.save_raw(column, self.dtypes[column])
+
+            meta = dict(self.meta, index=self.index, columns=self.columns, categories=categories)
+            with open(os.path.join(self.tmp_path, CACHE_META_FILE), 'w') as f:
+                json.dump(meta, f)
+            replace_store(self.tmp_path, self.path)
+        except (IOError, OSError) as e:
+            self.fail(e)
+        finally:
+            self.discard()
+
+    def discard(self):
+        """
+        Removes what is left of the temporary directory of the store.
+        """
+        if self.tmp_path is not None and os.path.exists(self.tmp_path):
+            shutil.rmtree(self.tmp_path, ignore_errors=True)
+
+    def fail(self, error):
+        self.error = error
+        self.discard()
+
+    def get_raw_path(self, column):
+        return os.path.join(self.tmp_path, '{}.raw'.format(column))
+
+    def get_codes(self, column, values):
+        """
+        Returns the codes of the strings or categories ``values`` among the categories of ``column`` seen so far.
+        """
+        categories = self.categories.setdefault(column, [])
+        known = set(categories)
+        categories.extend(category for category in pd.Categorical(values).categories.tolist() if category not in known)
+        return pd.Categorical(values, categories=categories).codes.astype(np.int32)
+
+    def save_codes(self, column):
+        """
+        Stores the codes of ``column`` with its categories sorted, so that the store does not depend on the chunks it
+        was written in. Returns the sorted categories.
+        """
+        categories = self.categories[column]
+        order = sorted(range(len(categories)), key=categories.__getitem__)
+        # Missing values (-1) pick the last entry
+        recode = np.full(len(categories) + 1, -1, dtype=np.int64)
+        recode[order] = np.arange(len(categories))
+        self.save_raw(column, np.dtype(np.int32), recode, get_code_dtype(len(categories)))
+        return [categories[i] for i in order]
+
+    def save_raw(self, column, dtype, recode=None, npy_dtype=None):
+        """
+        Turns the raw file of ``column`` into its ``.npy`` file block by block, recoding the values with ``recode`` if
+        given.
+        """
+        raw_path = self.get_raw_path(column)
+        npy_path = os.path.join(self.tmp_path, '{}.npy'.format(column))
+        npy_dtype = npy_dtype or dtype
+        if not self.rows:
+            np.save(npy_path, np.empty(0, dtype=npy_dtype))
+        else:
+            raw = np.memmap(raw_path, dtype=dtype, mode='r', shape=(self.rows,))
+            values = np.lib.format.open_memmap(npy_path, mode='w+', dtype=npy_dtype, shape=(self.rows,))
+            for start in range(0, self.rows, COPY_BLOCK_ROWS):
+                block = raw[start:start + COPY_BLOCK_ROWS]
+                values[start:start + COPY_BLOCK_ROWS] = block if recode is None else recode[block]
+            values.flush()
+            del raw, values
+        os.remove(raw_path)
+
+
+def get_code_dtype(number_categories):
+    """
+    Returns the smallest integer type holding the codes of ``number_categories`` categories and -1, as pandas does.
+    """
+    for dtype in [np.int8, np.int16, np.int32]:
+        if number_categories < np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+
+def replace_store(tmp_path, path):
+    """
+    Replaces the store in ``path`` with the complete store in ``tmp_path``. A directory cannot be replaced in a single
+    step, so the current store is moved aside first and readers in between see no store, which is a cache miss.
+    """
+    old_path = tmp_path + '.old'
+    try:
+        os.rename(path, old_path)
+    except (IOError, OSError):
+        pass  # There is no store yet or another run just moved it aside
+    try:
+        os.rename(tmp_path, path)
+    except (IOError, OSError):
+        pass  # Another run put its store in place first, which is just as valid
+    if os.path.exists(old_path):
+        shutil.rmtree(old_path, ignore_errors=True)
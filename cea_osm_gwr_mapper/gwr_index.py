@@ -0,0 +1,113 @@
+"""
+Builds a tiled spatial index of the GWR data. The cleaned GWR properties are stored sorted by LV95 grid tile, so that
+the GWR Mapper only needs to load the tiles intersecting a zone instead of scanning the whole register.
+"""
+from __future__ import division
+from __future__ import print_function
+
+import os
+
+import cea.config
+import numpy as np
+
+from cea_osm_gwr_mapper.gwr_cache import get_cache_key, read_meta, read_columns, write_columns
+from cea_osm_gwr_mapper.gwr_instrumentation import configure_logging, logger
+from cea_osm_gwr_mapper.gwr_manifest import get_gwr_paths
+from cea_osm_gwr_mapper.gwr_utils import read_gwr, filter_gwr_by_bounds
+
+__author__ = "Reynold Mok"
+__copyright__ = "Copyright 2020, Architecture and Building Systems - ETH Zurich"
+__credits__ = ["Reynold Mok"]
+__license__ = "MIT"
+__version__ = "0.1"
+__maintainer__ = "Reynold Mok"
+__email__ = "cea@arch.ethz.ch"
+__status__ = "Production"
+
+
+def get_index_path(gwr_path, index_dir=None):
+    """
+    Returns the path of the GWR index of ``gwr_path``. The index is stored next to the GWR file unless ``index_dir`` is
+    given.
+    """
+    gwr_path = os.path.abspath(gwr_path)
+    if not index_dir:
+        return gwr_path + '.index'
+    return os.path.join(index_dir, os.path.basename(gwr_path) + '.index')
+
+
+def get_tiles(e_coords, n_coords, tile_size):
+    return np.floor(e_coords / tile_size).astype(np.int64), np.floor(n_coords / tile_size).astype(np.int64)
+
+
+def build_gwr_index(gwr_df, index_path, tile_size, key):
+    """
+    Stores ``gwr_df`` in ``index_path`` sorted by grid tiles of ``tile_size`` meters, together with the row range of
+    every tile.
+    """
+    tile_e, tile_n = get_tiles(gwr_df['e_coordinate'].values, gwr_df['n_coordinate'].values, tile_size)
+    order = np.lexsort((tile_n, tile_e))
+    tile_e = tile_e[order]
+    tile_n = tile_n[order]
+
+    # Keep the position in the GWR file to restore the original order when loading
+    gwr_df = gwr_df.iloc[order].assign(gwr_row=order)
+
+    starts = np.flatnonzero(np.r_[True, (tile_e[1:] != tile_e[:-1]) | (tile_n[1:] != tile_n[:-1])])
+    stops = np.r_[starts[1:], len(order)]
+    tiles = {'{}_{}'.format(e, n): [int(start), int(stop)]
+             for e, n, start, stop in zip(tile_e[starts], tile_n[starts], starts, stops)}
+
+    write_columns(gwr_df, index_path, {'key': key, 'tile_size': tile_size, 'tiles': tiles})
+    logger.info('GWR index built with {} properties in {} tiles'.format(len(gwr_df), len(tiles)))
+
+
+def read_gwr_index(index_path, bounds, margin=0.0, gwr_path=None):
+    """
+    Returns the GWR properties within ``bounds`` (minx, miny, maxx, maxy) plus ``margin`` from the index, only loading
+    the tiles intersecting them. Returns None if there is no index or it was built from a different version of
+    ``gwr_path``.
+    """
+    meta = read_meta(index_path)
+    if meta is None or (gwr_path is not None and meta['key'] != get_cache_key(gwr_path)):
+        return None
+
+    minx, miny, maxx, maxy = bounds
+    bounds = (minx - margin, miny - margin, maxx + margin, maxy + margin)
+    (min_e, max_e), (min_n, max_n) = get_tiles(np.array(bounds[::2]), np.array(bounds[1::2]), meta['tile_size'])
+
+    tiles = meta['tiles']
+    rows = [np.arange(*tiles['{}_{}'.format(e, n)])
+            for e in range(min_e, max_e + 1) for n in range(min_n, max_n + 1) if '{}_{}'.format(e, n) in tiles]
+    rows = np.concatenate(rows) if rows else np.array([], dtype=np.int64)
+
+    try:
+        gwr_df = read_columns(index_path, meta, rows)
+    except (IOError, OSError, ValueError):
+        # The index was rebuilt after its metadata was read
+        return None
+    gwr_df = gwr_df.sort_values('gwr_row').drop(columns=['gwr_row'])
+
+    return filter_gwr_by_bounds(gwr_df, *bounds)
+
+
+def main(config):
+    """
+    Builds the GWR index of every GWR file set in ``gwr-mapper:gwr-path``.
+
+    :param cea.config.Configuration config: The configuration for this script, restricted to the scripts parameters.
+    :return: None
+    """
+    configure_logging()
+    for gwr_path in get_gwr_paths(config.gwr_mapper.gwr_path):
+        index_path = get_index_path(gwr_path, config.gwr_index.index_dir)
+
+        gwr_df = read_gwr(gwr_path, chunksize=config.gwr_mapper.read_chunk_size or None,
+                          cache=config.gwr_mapper.cache, cache_dir=config.gwr_mapper.cache_dir)
+
+        logger.info('Building GWR index: {}'.format(index_path))
+        build_gwr_index(gwr_df, index_path, config.gwr_index.tile_size, get_cache_key(gwr_path))
+
+
+if __name__ == '__main__':
+    main(cea.config.Configuration())
@@ -0,0 +1,166 @@
+"""
+Records the elapsed time, row counts, peak memory and throughput of each stage of a GWR Mapper run. Every stage is
+emitted as a log record (with the measurements in its ``stage`` attribute) and can be written to a JSON or CSV report.
+"""
+from __future__ import division
+
+import cProfile
+import csv
+import io
+import json
+import logging
+import pstats
+import sys
+import time
+from contextlib import contextmanager
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+logger = logging.getLogger('cea_osm_gwr_mapper')
+
+REPORT_COLUMNS = ['stage', 'seconds', 'rows_in', 'rows_out', 'unit', 'throughput', 'output_mb', 'bytes_written',
+                  'peak_rss_mb']
+PROFILE_STATS_LINES = 25
+
+
+def configure_logging():
+    """
+    Shows the log records of the GWR Mapper on the console, unless logging is already configured.
+    """
+    if not logger.handlers and not logging.getLogger().handlers:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+
+
+def get_peak_rss_mb():
+    """
+    Returns the peak resident memory of the process so far in MiB, or None if it cannot be measured on this platform.
+    """
+    if psutil is not None:
+        memory_info = psutil.Process().memory_info()
+        # Only Windows reports the peak, elsewhere ``ru_maxrss`` is used if available
+        if hasattr(memory_info, 'peak_wset'):
+            return memory_info.peak_wset / 1024 ** 2
+    if resource is not None:
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Reported in bytes on macOS and in KiB elsewhere
+        return max_rss / 1024 ** 2 if sys.platform == 'darwin' else max_rss / 1024
+    if psutil is not None:
+        return psutil.Process().memory_info().rss / 1024 ** 2
+    return None
+
+
+class RunReport(object):
+    """
+    Collects the measurements of the stages of a run. If ``max_memory_mb`` is given, a MemoryError is raised after the
+    first stage that takes the peak memory of the process above it.
+    """
+    def __init__(self, max_memory_mb=None):
+        self.stages = []
+        self.max_memory_mb = max_memory_mb
+
+    @contextmanager
+    def stage(self, name, rows_in=None, unit='rows'):
+        """
+        Measures the stage run within the context. Set ``rows_out`` of the yielded record to the number of rows produced
+        by the stage, or use ``record_output`` to also record the memory footprint of its output. The throughput is
+        given in ``unit`` per second of ``rows_in``, or of ``rows_out`` for stages without input rows. Files written by
+        the stage are recorded with ``record_written``.
+        """
+        logger.info(name)
+        record = {'stage': name, 'rows_in': rows_in, 'rows_out': None, 'unit': unit, 'output_mb': None,
+                  'bytes_written': None}
+        start = time.time()
+        yield record
+        seconds = time.time() - start
+
+        record['seconds'] = round(seconds, 4)
+        rows = rows_in if rows_in is not None else record['rows_out']
+        record['throughput'] = round(rows / seconds, 1) if rows and seconds > 0 else None
+        peak_rss_mb = get_peak_rss_mb()
+        record['peak_rss_mb'] = round(peak_rss_mb, 1) if peak_rss_mb is not None else None
+        self.stages.append(record)
+
+        logger.info(format_stage(record), extra={'stage': record})
+
+        if self.max_memory_mb and record['peak_rss_mb'] is not None and record['peak_rss_mb'] > self.max_memory_mb:
+            raise MemoryError('Stage "{}" exceeded the memory limit of {} MiB with a peak of {:.0f} MiB'.format(
+                name, self.max_memory_mb, record['peak_rss_mb']))
+
+    def write(self, path):
+        """
+        Writes the measurements of all stages to ``path``, as CSV if it ends with ``.csv`` and as JSON otherwise.
+        """
+        if path.endswith('.csv'):
+            with open(path, 'w', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=REPORT_COLUMNS, extrasaction='ignore')
+                writer.writeheader()
+                writer.writerows(self.stages)
+        else:
+            with open(path, 'w') as f:
+                json.dump({'total_seconds': round(sum(stage['seconds'] for stage in self.stages), 4),
+                           'stages': self.stages}, f, indent=2)
+        logger.info('GWR Mapper run report written to: {}'.format(path))
+
+
+def record_output(record, df):
+    """
+    Records the number of rows and the memory footprint of ``df`` as the output of the stage of ``record``.
+    """
+    record['rows_out'] = len(df)
+    record['output_mb'] = round(df.memory_usage(deep=True).sum() / 1024 ** 2, 2)
+
+
+def record_written(record, path, bytes_written):
+    """
+    Records the number of bytes written to ``path`` by the stage of ``record``, 0 if the file was left unchanged.
+    """
+    record['bytes_written'] = (record['bytes_written'] or 0) + bytes_written
+    record.setdefault('files', {})[path] = bytes_written
+
+
+def format_stage(record):
+    message = '  done in {:.2f} s'.format(record['seconds'])
+    if record['rows_in'] is not None:
+        message += ', {} {} in'.format(record['rows_in'], record['unit'])
+    if record['rows_out'] is not None:
+        message += ', {} rows out'.format(record['rows_out'])
+    if record['throughput'] is not None:
+        message += ' ({:.0f} {}/s)'.format(record['throughput'], record['unit'])
+    if record['output_mb'] is not None:
+        message += ', output {:.1f} MiB'.format(record['output_mb'])
+    if record['bytes_written'] is not None:
+        message += ', wrote {:.1f} KiB'.format(record['bytes_written'] / 1024)
+    if record['peak_rss_mb'] is not None:
+        message += ', peak RSS {:.0f} MiB'.format(record['peak_rss_mb'])
+    return message
+
+
+@contextmanager
+def profile(stats_path):
+    """
+    Profiles the code run within the context with cProfile, dumping the stats to ``stats_path`` and logging the
+    functions with the largest cumulative time.
+    """
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        profiler.dump_stats(stats_path)
+
+        stats_output = io.StringIO()
+        pstats.Stats(profiler, stream=stats_output).sort_stats('cumulative').print_stats(PROFILE_STATS_LINES)
+        logger.info(stats_output.getvalue())
+        logger.info('GWR Mapper profile written to: {}'.format(stats_path))
@@ -0,0 +1,128 @@
+"""
+Support for GWR data split over several exports (e.g. one per canton). ``gwr-mapper:gwr-path`` can point to a single
+GWR file, a directory of GWR files or a glob pattern. A manifest next to the files (in the deepest directory of a glob
+pattern without wildcards) holds the coordinate bounds and row count of every file by absolute path, so that only the
+files intersecting a zone are read. Entries are refreshed when a file changes.
+"""
+from __future__ import print_function
+
+import glob
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from cea_osm_gwr_mapper.gwr_instrumentation import logger
+from cea_osm_gwr_mapper.gwr_utils import GWR_HEADERS
+
+MANIFEST_VERSION = 2
+MANIFEST_FILE = 'gwr-manifest.json'
+GWR_FILE_PATTERN = '*.txt'
+SCAN_CHUNK_SIZE = 1000000
+
+
+def get_gwr_paths(gwr_path):
+    """
+    Returns the GWR files of ``gwr_path``, which is either a GWR file, a directory of GWR files or a glob pattern.
+    """
+    if os.path.isdir(gwr_path):
+        return sorted(glob.glob(os.path.join(gwr_path, GWR_FILE_PATTERN)))
+    if glob.has_magic(gwr_path):
+        return sorted(path for path in glob.glob(gwr_path) if os.path.isfile(path))
+    return [gwr_path]
+
+
+def get_manifest_path(gwr_path):
+    """
+    Returns the path of the manifest of the GWR files of ``gwr_path``, stored in the directory holding them. For a glob
+    pattern that is the deepest directory of the pattern without wildcards, e.g. ``/gwr`` for ``/gwr/*/gwr.txt``.
+    """
+    gwr_path = os.path.abspath(gwr_path)
+    if os.path.isdir(gwr_path):
+        return os.path.join(gwr_path, MANIFEST_FILE)
+
+    directory = os.path.dirname(gwr_path)
+    while glob.has_magic(directory):
+        directory = os.path.dirname(directory)
+    return os.path.join(directory, MANIFEST_FILE)
+
+
+def scan_gwr_file(gwr_path):
+    """
+    Returns the manifest entry of ``gwr_path`` with its coordinate bounds (None if it has no coordinates) and row count.
+    """
+    rows = 0
+    bounds = [np.inf, np.inf, -np.inf, -np.inf]
+    reader = pd.read_csv(gwr_path, sep='\t', names=GWR_HEADERS, usecols=['e_coordinate', 'n_coordinate'],
+                         dtype=np.float64, index_col=False, chunksize=SCAN_CHUNK_SIZE)
+    for df in reader:
+        rows += len(df)
+        df = df.dropna()
+        if not df.empty:
+            bounds = [min(bounds[0], df['e_coordinate'].min()), min(bounds[1], df['n_coordinate'].min()),
+                      max(bounds[2], df['e_coordinate'].max()), max(bounds[3], df['n_coordinate'].max())]
+
+    stat = os.stat(gwr_path)
+    return {'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'rows': rows,
+            'bounds': [float(b) for b in bounds] if np.isfinite(bounds).all() else None}
+
+
+def get_manifest(gwr_path):
+    """
+    Returns the manifest entries of the GWR files of ``gwr_path`` by path, scanning files that are new or changed since
+    the manifest was written and updating it.
+    """
+    manifest_path = get_manifest_path(gwr_path)
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest.get('version') != MANIFEST_VERSION:
+            manifest = {}
+    previous_files = manifest.get('files', {})
+
+    # Keep the entries of files not matched by a glob pattern, unless they were removed
+    files = {path: entry for path, entry in previous_files.items() if os.path.exists(path)}
+    entries = {}
+    for path in get_gwr_paths(gwr_path):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        entry = previous_files.get(path)
+        if entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime:
+            logger.info('Scanning GWR file for manifest: {}'.format(path))
+            entry = scan_gwr_file(path)
+        entries[path] = files[path] = entry
+
+    if files != previous_files:
+        try:
+            tmp_path = manifest_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump({'version': MANIFEST_VERSION, 'files': files}, f, indent=2)
+            os.replace(tmp_path, manifest_path)
+        except (IOError, OSError) as e:
+            logger.warning('Unable to write GWR manifest: {}'.format(e))
+
+    return entries
+
+
+def select_gwr_files(gwr_path, bounds):
+    """
+    Returns the GWR files of ``gwr_path`` with properties within ``bounds`` (minx, miny, maxx, maxy). A single GWR file
+    is returned as is without building a manifest.
+    """
+    if not os.path.isdir(gwr_path) and not glob.has_magic(gwr_path):
+        return [gwr_path]
+
+    minx, miny, maxx, maxy = bounds
+    selected = []
+    for path, entry in get_manifest(gwr_path).items():
+        if entry['bounds'] is None:
+            continue
+        file_minx, file_miny, file_maxx, file_maxy = entry['bounds']
+        if file_minx <= maxx and minx <= file_maxx and file_miny <= maxy and miny <= file_maxy:
+            selected.append(path)
+
+    return sorted(selected)
@@ -0,0 +1,645 @@
+"""
+Maps the properties of the GWR buildings to the zone buildings of a scenario and updates its typology and supply
+systems. Kept apart from ``gwr_mapper`` so that registering the plugin does not import the GIS and archetype stack.
+"""
+from __future__ import division
+from __future__ import print_function
+
+import hashlib
+import json
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+from cea.datamanagement.archetypes_mapper import archetypes_mapper
+from cea.utilities.dbf import dataframe_to_dbf, dbf_to_dataframe
+from cea.utilities.parallel import vectorize
+from scipy.spatial import cKDTree
+from shapely.geometry import Point
+
+from cea_osm_gwr_mapper import __version__ as plugin_version
+from cea_osm_gwr_mapper.gwr_cache import get_cache_key, read_cache, write_cache
+from cea_osm_gwr_mapper.gwr_index import get_index_path, read_gwr_index
+from cea_osm_gwr_mapper.gwr_instrumentation import RunReport, logger, record_output, record_written
+from cea_osm_gwr_mapper.gwr_manifest import select_gwr_files
+from cea_osm_gwr_mapper.gwr_output import get_changed_rows, read_output, write_atomic, write_csv, write_dbf, \
+    write_shapefile
+from cea_osm_gwr_mapper.gwr_utils import read_gwr, LV95_PROJECTION, gwr_to_cea_code, filter_gwr_by_bounds, \
+    get_read_chunk_size, concat_gwr, get_translation_hash, fill_building_type
+
+__author__ = "Reynold Mok"
+__copyright__ = "Copyright 2020, Architecture and Building Systems - ETH Zurich"
+__credits__ = ["Daren Thomas"]
+__license__ = "MIT"
+__version__ = "0.1"
+__maintainer__ = "Reynold Mok"
+__email__ = "cea@arch.ethz.ch"
+__status__ = "Production"
+
+CHUNKS_PER_PROCESS = 4
+MIN_BUILDINGS_PER_PROCESS = 1000  # Smaller zones are not worth the overhead of starting processes
+
+# Properties of each building kept between runs to only map new or changed buildings
+MAPPED_PROPERTIES = ['construction_year', 'number_floors', 'building_type', 'occupancy_ratio', 'heating_tech_code',
+                     'hot_water_tech_code']
+
+# Version of how the GWR properties of a building are reduced and filled in, increase it when
+# ``reduce_building_properties`` or ``fill_missing_properties`` change so that the buildings are mapped again
+MAPPING_VERSION = 3
+
+# How each building was matched to GWR properties (within its footprint, to the nearest GWR point or none), the
+# distance to the matched GWR point and its federal id if matched to the nearest GWR point
+MATCH_COLUMNS = ['match_method', 'match_distance', 'match_federal_id']
+
+# Added to the names of the surroundings buildings while they are mapped together with the zone buildings
+SURROUNDINGS_PREFIX = 'surroundings:'
+
+# Up to 3 occupancy types and their ratios of an occupancy ratio string
+OCCUPANCY_RATIO_PATTERN = r'^([^:;]+):([^;]*)(?:;([^:;]+):([^;]*))?(?:;([^:;]+):([^;]*))?$'
+
+# Columns of the STANDARD_DEFINITION sheet of the construction standards database used to generate the typology
+STANDARD_DEFINITION_COLUMNS = ['STANDARD', 'YEAR_START', 'YEAR_END']
+
+
+def map_props_to_geoms(zone_gdf, gwr_gdf, processes=1):
+    """
+    Assigns every GWR point to the zone building it lies within using a single spatial join and reduces the matches to
+    one row of properties per building (in the order of ``zone_gdf``). Buildings without any GWR point get an empty row.
+
+    With more than one process, the zone is split into spatially coherent chunks that are mapped in parallel, each only
+    with the GWR points within its bounds. The result does not depend on the number of processes.
+    """
+    zone_geometries = zone_gdf[['Name', 'geometry']].reset_index(drop=True)
+
+    processes = min(processes, len(zone_geometries) // MIN_BUILDINGS_PER_PROCESS)
+    if processes > 1:
+        zone_chunks = split_by_grid(zone_geometries, processes * CHUNKS_PER_PROCESS)
+        gwr_chunks = [filter_gwr_by_bounds(gwr_gdf, *zone_chunk['geometry'].total_bounds) for zone_chunk in zone_chunks]
+        properties_df = pd.concat(vectorize(map_props_to_geoms, processes)(zone_chunks, gwr_chunks))
+        return properties_df.set_index('Name').reindex(zone_geometries['Name']).reset_index()
+
+    matched_properties = match_gwr_to_buildings(zone_geometries, gwr_gdf)
+    properties_df = reduce_building_properties(matched_properties)
+
+    # Add empty rows for buildings without any properties found within their geometry
+    properties_df = properties_df.set_index('Name').reindex(zone_geometries['Name']).reset_index()
+
+    return properties_df
+
+
+def match_gwr_to_buildings(zone_geometries, gwr_gdf):
+    """
+    Returns the GWR points within each zone building, with the ``Name`` of the building they lie within.
+    ``zone_geometries`` must have a default range index.
+    """
+    # Find candidate pairs using the spatial index, then keep only points strictly within the building geometry
+    candidates = gpd.sjoin(gwr_gdf, zone_geometries, how='inner').reset_index()
+    building_geometries = gpd.GeoSeries(zone_geometries['geometry'].iloc[candidates['index_right']].values,
+                                        index=candidates.index, crs=zone_geometries.crs)
+    properties_in_geometry = candidates['geometry'].within(building_geometries)
+
+    return candidates[properties_in_geometry].drop(columns=['index_right'])
+
+
+def match_nearest_gwr(zone_geometries, gwr_gdf, buildings, max_distance):
+    """
+    Returns the nearest GWR point within ``max_distance`` of each of ``buildings`` (names in ``zone_geometries``) among
+    the points that lie within none of the zone buildings, with the distance in ``match_distance``. Every point is
+    matched to at most one building, going from the shortest distance to the longest.
+    """
+    points_gdf = gwr_gdf.rename_axis('federal_id').reset_index()
+    assigned = gpd.sjoin(points_gdf[['geometry']], zone_geometries[['geometry']], predicate='within').index
+    points_gdf = points_gdf.drop(assigned.unique()).reset_index(drop=True)
+    building_geometries = zone_geometries.set_index('Name').loc[buildings, 'geometry'].reset_index(drop=True)
+    if points_gdf.empty or building_geometries.empty:
+        return points_gdf.iloc[:0].assign(Name=pd.Series(dtype=object), match_distance=pd.Series(dtype=float))
+
+    # Find candidate points around the center of the bounding box of each building, within a radius that covers every
+    # point within ``max_distance`` of the building
+    building_bounds = building_geometries.bounds
+    centers = np.column_stack([(building_bounds['minx'] + building_bounds['maxx']) / 2,
+                               (building_bounds['miny'] + building_bounds['maxy']) / 2])
+    radii = np.hypot(building_bounds['maxx'] - building_bounds['minx'],
+                     building_bounds['maxy'] - building_bounds['miny']) / 2 + max_distance
+    tree = cKDTree(np.column_stack([points_gdf['e_coordinate'], points_gdf['n_coordinate']]))
+    candidates = tree.query_ball_point(centers, radii)
+    building_positions = np.repeat(np.arange(len(candidates)), [len(c) for c in candidates])
+    point_positions = np.concatenate([np.asarray(c, dtype=int) for c in candidates])
+
+    distances = gpd.GeoSeries(building_geometries.values[building_positions]).distance(
+        gpd.GeoSeries(points_gdf['geometry'].values[point_positions])).values
+    within_distance = distances <= max_distance
+    pairs = pd.DataFrame({'building': building_positions[within_distance], 'point': point_positions[within_distance],
+                          'distance': distances[within_distance]}).sort_values(['distance', 'building', 'point'])
+
+    matched_buildings = {}
+    matched_points = set()
+    for building, point, distance in zip(pairs['building'], pairs['point'], pairs['distance']):
+        if building not in matched_buildings and point not in matched_points:
+            matched_buildings[building] = (point, distance)
+            matched_points.add(point)
+
+    positions = sorted(matched_buildings)
+    matched_df = points_gdf.iloc[[matched_buildings[b][0] for b in positions]].reset_index(drop=True)
+    matched_df['Name'] = np.asarray(buildings)[positions]
+    matched_df['match_distance'] = [matched_buildings[b][1] for b in positions]
+    return matched_df
+
+
+def split_by_grid(zone_gdf, number_of_chunks):
+    """
+    Splits the zone buildings into at most ``number_of_chunks`` spatially coherent chunks, by the cell of a regular grid
+    over the zone that the center of their bounding box falls in.
+    """
+    minx, miny, maxx, maxy = zone_gdf['geometry'].total_bounds
+    building_bounds = zone_gdf['geometry'].bounds
+    center_x = ((building_bounds['minx'] + building_bounds['maxx']) / 2).values
+    center_y = ((building_bounds['miny'] + building_bounds['maxy']) / 2).values
+
+    cells = int(math.sqrt(number_of_chunks))
+    column = np.minimum((center_x - minx) / max(maxx - minx, 1.0) * cells, cells - 1).astype(int)
+    row = np.minimum((center_y - miny) / max(maxy - miny, 1.0) * cells, cells - 1).astype(int)
+    cell = row * cells + column
+
+    return [zone_gdf[cell == c] for c in np.unique(cell)]
+
+
+def reduce_building_properties(matched_properties_df):
+    """
+    Reduces the GWR properties matched to each building (identified by ``Name``) to a single row per building using
+    grouped operations over all buildings at once.
+    """
+    properties_df = matched_properties_df.reset_index(drop=True)
+    grouped = properties_df.groupby('Name', sort=False)
+
+    # Keep the first property of each building for the remaining columns
+    out = properties_df.drop_duplicates('Name').set_index('Name')
+
+    # Use latest year
+    out['construction_year'] = grouped['construction_year'].max()
+
+    # Use highest number of floors
+    out['number_floors'] = grouped['number_floors'].max()
+
+    # Get gross floor area of each property
+    properties_df['gross_floor_area'] = properties_df['building_area'].fillna(1.0).astype(float) \
+                                        * properties_df['number_floors']
+
+    # Use building type, heating tech and hot water tech with largest gross floor area
+    out['building_type'] = get_dominant_property(properties_df, 'building_type')
+    out['heating_tech_code'] = get_dominant_property(properties_df, 'heating_tech_code')
+    out['hot_water_tech_code'] = get_dominant_property(properties_df, 'hot_water_tech_code')
+
+    out['occupancy_ratio'] = get_occupancy_ratio(properties_df)
+    single_property = grouped.size() == 1
+    out.loc[single_property, 'occupancy_ratio'] = out.loc[single_property, 'building_type'].astype(str) + ':1.0'
+
+    # Building type filled in for any of the properties of unknown GWR building class
+    out['building_type_fill'] = grouped['building_type_fill'].first()
+
+    return out.reset_index()
+
+
+def get_dominant_property(properties_df, column):
+    """
+    Returns the value of ``column`` with the largest gross floor area for each building, ties going to the first value
+    in sorted order.
+    """
+    gross_floor_area = properties_df.groupby(['Name', column], observed=True)['gross_floor_area'].sum().reset_index()
+    largest_gross_floor_area = gross_floor_area.groupby('Name')['gross_floor_area'].transform('max')
+    largest = gross_floor_area['gross_floor_area'] == largest_gross_floor_area
+    gross_floor_area = gross_floor_area[largest].sort_values(['Name', column])
+    return gross_floor_area.drop_duplicates('Name').set_index('Name')[column]
+
+
+def get_occupancy_ratio(properties_df):
+    """
+    Returns the occupancy ratio string (e.g. ``MULTI_RES:0.7;RETAIL:0.3``) of each building based on the share of gross
+    floor area of each building type.
+    """
+    type_gfa = properties_df.groupby(['Name', 'building_type'], observed=True)['gross_floor_area'].sum().reset_index()
+    grouped = type_gfa.groupby('Name')['gross_floor_area']
+    type_gfa['percentage'] = type_gfa['gross_floor_area'] / grouped.transform('sum')
+    num_types = grouped.transform('size')
+
+    # Round and order by largest share for buildings with multiple types, ties keep their sorted order
+    multiple_types = num_types > 1
+    type_gfa.loc[multiple_types, 'percentage'] = type_gfa.loc[multiple_types, 'percentage'].round(5)
+    type_gfa = type_gfa.sort_values(['Name', 'percentage', 'building_type'], ascending=[True, False, True])
+    type_gfa['rank'] = type_gfa.groupby('Name').cumcount()
+
+    # CEA only supports maximum of 3 different occupancy types in one building
+    type_gfa = type_gfa[type_gfa['rank'] < 3]
+    occupancy = type_gfa.pivot(index='Name', columns='rank', values='building_type').reindex(columns=range(3))
+    percentage = type_gfa.pivot(index='Name', columns='rank', values='percentage').reindex(columns=range(3))
+
+    # Last type takes up the remainder
+    num = occupancy.notna().sum(axis=1)
+    two_types = num == 2
+    three_types = num == 3
+    percentage.loc[two_types, 1] = (1.0 - percentage.loc[two_types, 0].fillna(0.0)).round(5)
+    percentage.loc[three_types, 2] = (1.0 - (percentage.loc[three_types, 0].fillna(0.0)
+                                             + percentage.loc[three_types, 1].fillna(0.0))).round(5)
+
+    ratios = [occupancy[i].astype(object) + ':' + percentage[i].map(str) for i in range(3)]
+    occupancy_ratio = ratios[0]
+    for ratio in ratios[1:]:
+        occupancy_ratio = occupancy_ratio.where(ratio.isna(), occupancy_ratio + ';' + ratio)
+
+    return occupancy_ratio
+
+
+def generate_typology(properties_df, standard_definition_df, out_of_range='raise'):
+    out = pd.DataFrame()
+    out['Name'] = properties_df['Name']
+    out['YEAR'] = properties_df['construction_year']
+    out['STANDARD'] = get_construction_standards(out['YEAR'].values, standard_definition_df, out_of_range)
+
+    # Split up to 3 occupancy types and their ratios (e.g. ``MULTI_RES:0.7;RETAIL:0.3``) into columns at once
+    ratio_split = properties_df['occupancy_ratio'].str.extract(OCCUPANCY_RATIO_PATTERN)
+    ratio_split.index = pd.Index(properties_df['Name'].values, name='Name')
+    ratio_split.columns = ['1ST_USE', '1ST_USE_R', '2ND_USE', '2ND_USE_R', '3RD_USE', '3RD_USE_R']
+    for use in ['1ST_USE', '2ND_USE', '3RD_USE']:
+        ratio_split[use] = ratio_split[use].fillna('NONE').astype(str)
+        ratio_split[use + '_R'] = ratio_split[use + '_R'].fillna(0.0).astype(float)
+    out = pd.concat([out.set_index('Name'), ratio_split], axis=1).reset_index()
+
+    out['REFERENCE'] = 'GWR Mapper'
+
+    return out
+
+
+def get_construction_standards(years, standard_definition_df, out_of_range='raise'):
+    """
+    Returns the construction standard of each of ``years`` from the ``YEAR_START`` and ``YEAR_END`` (inclusive) ranges
+    of ``standard_definition_df``, which must not overlap.
+
+    :param out_of_range: What to do with years outside all ranges, ``raise`` a ValueError or use the ``nearest`` range
+    """
+    standards = standard_definition_df.sort_values('YEAR_START', kind='mergesort')
+    year_start = standards['YEAR_START'].values
+    year_end = standards['YEAR_END'].values
+    if (year_start[1:] <= year_end[:-1]).any():
+        raise ValueError('The year ranges of the construction standards overlap')
+
+    # Find the last range starting before each year and check that the year is not past its end
+    position = np.searchsorted(year_start, years, side='right') - 1
+    within_range = (position >= 0) & (years <= year_end[np.maximum(position, 0)])
+
+    if not within_range.all():
+        outside_years = years[~within_range]
+        if out_of_range != 'nearest':
+            raise ValueError('No construction standard defined for the years {}'.format(
+                sorted(set(outside_years.tolist()))))
+        distance = np.maximum(year_start[np.newaxis, :] - outside_years[:, np.newaxis],
+                              outside_years[:, np.newaxis] - year_end[np.newaxis, :])
+        position[~within_range] = distance.argmin(axis=1)
+
+    return standards['STANDARD'].values[position]
+
+
+def read_standard_definition(database_path, cache_path):
+    """
+    Returns the STANDARD_DEFINITION sheet of the construction standards database in ``database_path``. Parsing the
+    workbook is slow, so the sheet is cached in ``cache_path`` and reused until the database file changes.
+    """
+    stat = os.stat(database_path)
+    key = {'path': os.path.abspath(database_path), 'size': stat.st_size, 'mtime': stat.st_mtime}
+    standard_definition_df = read_cache(cache_path, key)
+    if standard_definition_df is not None:
+        return standard_definition_df.astype({'STANDARD': object}).reset_index(drop=True)
+
+    standard_definition_df = pd.read_excel(database_path, sheet_name='STANDARD_DEFINITION')
+    standard_definition_df = standard_definition_df[STANDARD_DEFINITION_COLUMNS]
+    write_cache(standard_definition_df, cache_path, key)
+    return standard_definition_df
+
+
+def read_gwr_data(config, gwr_paths, bounds):
+    """
+    Reads the GWR properties within ``bounds`` from each of ``gwr_paths``.
+    """
+    gwr_dfs = [read_gwr_file(config, gwr_path, bounds) for gwr_path in gwr_paths]
+    return concat_gwr(gwr_dfs)
+
+
+def read_gwr_file(config, gwr_path, bounds):
+    """
+    Reads the GWR properties within ``bounds`` from the GWR index if it is up to date, otherwise from the GWR file.
+    """
+    index_path = get_index_path(gwr_path, config.gwr_index.index_dir)
+    if os.path.exists(index_path):
+        gwr_df = read_gwr_index(index_path, bounds, gwr_path=gwr_path)
+        if gwr_df is not None:
+            logger.info('Reading GWR data from index: {}'.format(index_path))
+            return gwr_df
+        logger.info('GWR index is out of date, run `gwr-index` to rebuild it: {}'.format(index_path))
+
+    chunksize = config.gwr_mapper.read_chunk_size
+    if not chunksize and config.gwr_mapper.max_memory:
+        chunksize = get_read_chunk_size(config.gwr_mapper.max_memory)
+    return read_gwr(gwr_path, bounds=bounds, chunksize=chunksize or None,
+                    cache=config.gwr_mapper.cache, cache_dir=config.gwr_mapper.cache_dir)
+
+
+def get_union_bounds(all_bounds):
+    """
+    Returns the bounds (minx, miny, maxx, maxy) covering all of ``all_bounds``.
+    """
+    all_bounds = np.asarray(all_bounds)
+    return np.r_[all_bounds[:, :2].min(axis=0), all_bounds[:, 2:].max(axis=0)]
+
+
+def get_building_fingerprints(zone_gdf):
+    """
+    Returns a hash of the geometry of every building, used to find buildings that changed since the last run.
+    """
+    return pd.Series([hashlib.sha1(geometry.wkb).hexdigest() for geometry in zone_gdf['geometry']],
+                     index=zone_gdf['Name'].values)
+
+
+def get_mapping_version(gwr_paths, nearest_distance=0.0):
+    """
+    Returns the version of the GWR data that buildings are mapped against. Buildings mapped against a different version
+    of the GWR data, with a different ``nearest_distance`` or by a different version of the translation of GWR codes or
+    of the plugin are mapped again.
+    """
+    return json.dumps({'gwr': [get_cache_key(gwr_path) for gwr_path in gwr_paths],
+                       'nearest_distance': float(nearest_distance),
+                       'translation': get_translation_hash(),
+                       'mapping_version': MAPPING_VERSION,
+                       'plugin_version': plugin_version}, sort_keys=True)
+
+
+def fill_missing_properties(properties_df):
+    """
+    Fills in the properties of buildings without any GWR properties with the most common building type and the typical
+    properties of buildings of that type.
+    """
+    properties_df = properties_df.copy()
+    # Categorical columns only accept fill values among their categories
+    for column in ['occupancy_ratio', 'heating_tech_code', 'hot_water_tech_code']:
+        properties_df[column] = properties_df[column].astype(object)
+
+    # Fill empty rows with most common building type
+    building_type = properties_df['building_type'].value_counts().idxmax()
+    common_building_properties_df = properties_df.loc[properties_df['building_type'] == building_type]
+    construction_year = common_building_properties_df['construction_year'].median()
+    number_floors = common_building_properties_df['number_floors'].median()
+    heating_tech_code = common_building_properties_df['heating_tech_code'].value_counts().idxmax()
+    hot_water_tech_code = common_building_properties_df['hot_water_tech_code'].value_counts().idxmax()
+
+    properties_df['construction_year'] = properties_df['construction_year'].fillna(construction_year).astype(int)
+    properties_df['number_floors'] = properties_df['number_floors'].fillna(number_floors).astype(int)
+    properties_df['occupancy_ratio'] = properties_df['occupancy_ratio'].fillna('{}:{}'.format(building_type, 1.0)).astype(str)
+    properties_df['heating_tech_code'] = properties_df['heating_tech_code'].fillna(heating_tech_code).astype(str)
+    properties_df['hot_water_tech_code'] = properties_df['hot_water_tech_code'].fillna(hot_water_tech_code).astype(str)
+
+    return properties_df
+
+
+def select_gwr_data_files(config, bounds):
+    """
+    Returns the GWR files set in ``gwr-mapper:gwr-path`` covering ``bounds``.
+    """
+    gwr_paths = select_gwr_files(config.gwr_mapper.gwr_path, bounds)
+    if not gwr_paths:
+        raise ValueError('None of the GWR files in {} cover the zone'.format(config.gwr_mapper.gwr_path))
+    return gwr_paths
+
+
+def load_gwr_data(config, gwr_paths, bounds, report):
+    """
+    Reads the GWR properties within ``bounds`` from ``gwr_paths``, translates them to CEA codes and creates their
+    points. Returns the GWR data as expected by ``gwr_mapper``, which fills in the building type of unknown GWR building
+    classes from the GWR data it is given.
+    """
+    # Filter GWR data to zone extent while reading
+    with report.stage('Filtering GWR data to location', unit='GWR rows') as stage:
+        gwr_df = read_gwr_data(config, gwr_paths, bounds)
+        record_output(stage, gwr_df)
+
+    with report.stage('Translating GWR to CEA code', rows_in=len(gwr_df), unit='GWR rows') as stage:
+        gwr_df = gwr_to_cea_code(gwr_df)
+        record_output(stage, gwr_df)
+
+    with report.stage('Creating GWR points', rows_in=len(gwr_df), unit='GWR rows') as stage:
+        coord_points = [Point(x, y) for x, y in zip(gwr_df['e_coordinate'], gwr_df['n_coordinate'])]
+        gwr_gdf = gpd.GeoDataFrame(gwr_df, geometry=coord_points, crs=LV95_PROJECTION)
+        record_output(stage, gwr_gdf)
+
+    return {'gwr_paths': gwr_paths, 'gwr_gdf': gwr_gdf}
+
+
+def gwr_mapper(config, locator, gwr_data=None):
+    """
+    Maps the GWR properties to the zone buildings and returns the ``RunReport`` with the measurements of each stage.
+
+    :param gwr_data: GWR data covering the zone as returned by ``load_gwr_data``, to map several scenarios against the
+        same GWR data. The GWR data is read for the zone if None.
+    """
+    zone_path = locator.get_zone_geometry()
+    surroundings_path = locator.get_surroundings_geometry()
+    state_path = os.path.join(os.path.dirname(locator.get_building_typology()), 'gwr_mapper_state')
+    standard_definition_path = os.path.join(os.path.dirname(state_path), 'gwr_mapper_standards')
+    report = RunReport(config.gwr_mapper.max_memory)
+
+    # The construction standards are read in the background while the zone and GWR data are read and mapped
+    executor = ThreadPoolExecutor(max_workers=1)
+    standard_definition = executor.submit(read_standard_definition, locator.get_database_construction_standards(),
+                                          standard_definition_path)
+    executor.shutdown(wait=False)
+
+    with report.stage('Reading zone geometries', unit='buildings') as stage:
+        zone_gdf = gpd.read_file(zone_path)
+        reprojected_zone_gdf = zone_gdf.to_crs(LV95_PROJECTION)
+        bounds = reprojected_zone_gdf['geometry'].total_bounds
+        record_output(stage, zone_gdf)
+
+    surroundings_gdf = None
+    if config.gwr_mapper.map_surroundings:
+        if os.path.exists(surroundings_path):
+            with report.stage('Reading surroundings geometries', unit='buildings') as stage:
+                surroundings_gdf = gpd.read_file(surroundings_path)
+                reprojected_surroundings_gdf = surroundings_gdf.to_crs(LV95_PROJECTION)
+                surroundings_geometries = reprojected_surroundings_gdf[['Name', 'geometry']].assign(
+                    Name=SURROUNDINGS_PREFIX + reprojected_surroundings_gdf['Name'].astype(str))
+                # The GWR data is read once for the zone and surroundings together
+                bounds = get_union_bounds([bounds, reprojected_surroundings_gdf['geometry'].total_bounds])
+                record_output(stage, surroundings_gdf)
+        else:
+            logger.info('No surroundings geometries to map: {}'.format(surroundings_path))
+
+    # Only map buildings that are new or changed since the last run against the same GWR data
+    with report.stage('Finding new or changed buildings', rows_in=len(zone_gdf), unit='buildings') as stage:
+        fingerprints = get_building_fingerprints(zone_gdf)
+        gwr_paths = select_gwr_data_files(config, bounds) if gwr_data is None else gwr_data['gwr_paths']
+        mapping_version = get_mapping_version(gwr_paths, config.gwr_mapper.nearest_distance)
+        previous_df = read_cache(state_path, mapping_version) if config.gwr_mapper.incremental else None
+        if previous_df is not None:
+            unchanged = previous_df.index[previous_df['fingerprint'] == fingerprints.reindex(previous_df.index)]
+        else:
+            unchanged = pd.Index([])
+        changed_zone_gdf = reprojected_zone_gdf[~reprojected_zone_gdf['Name'].isin(unchanged)]
+        stage['rows_out'] = len(changed_zone_gdf)
+
+    # The building type filled in for unknown GWR building classes depends on the GWR data within the zone extent, so
+    # it can only change with the buildings of the zone
+    zone_changed = previous_df is None or len(unchanged) != len(zone_gdf) or len(unchanged) != len(previous_df)
+    if zone_changed or surroundings_gdf is not None:
+        if gwr_data is None:
+            gwr_data = load_gwr_data(config, gwr_paths, bounds, report)
+        gwr_gdf, building_type_fill = fill_building_type(gwr_data['gwr_gdf'])
+
+        # Unchanged buildings mapped with a different building type filled in are mapped again
+        if len(unchanged):
+            previous_fill = previous_df.loc[unchanged, 'building_type_fill']
+            unchanged = unchanged[(previous_fill.isna() | (previous_fill == building_type_fill)).values]
+            changed_zone_gdf = reprojected_zone_gdf[~reprojected_zone_gdf['Name'].isin(unchanged)]
+    logger.info('Mapping {} new or changed buildings, {} unchanged'.format(len(changed_zone_gdf), len(unchanged)))
+
+    mapped_columns = MAPPED_PROPERTIES + MATCH_COLUMNS + ['building_type_fill']
+    mapped_properties = [previous_df.loc[unchanged, mapped_columns].reset_index()] if len(unchanged) else []
+    if not changed_zone_gdf.empty or surroundings_gdf is not None:
+        # Zone and surroundings buildings are matched to the GWR points in a single spatial join
+        buildings_gdf = changed_zone_gdf[['Name', 'geometry']]
+        if surroundings_gdf is not None:
+            buildings_gdf = pd.concat([buildings_gdf, surroundings_geometries])
+        with report.stage('Mapping GWR Buildings to CEA Buildings', rows_in=len(buildings_gdf),
+                          unit='buildings') as stage:
+            properties_df = map_props_to_geoms(buildings_gdf, gwr_gdf, config.get_number_of_processes())
+            surroundings_properties_df = properties_df.iloc[len(changed_zone_gdf):]
+            properties_df = properties_df.iloc[:len(changed_zone_gdf)].copy()
+            matched = properties_df[MAPPED_PROPERTIES].notna().any(axis=1)
+            properties_df['match_method'] = np.where(matched, 'within', 'none')
+            properties_df['match_distance'] = np.where(matched, 0.0, np.nan)
+            properties_df['match_federal_id'] = np.nan
+            record_output(stage, properties_df)
+
+        if not changed_zone_gdf.empty:
+            mapped_properties.append(properties_df[['Name'] + mapped_columns])
+    mapped_df = pd.concat(mapped_properties).set_index('Name').reindex(zone_gdf['Name'])
+
+    # Every building without GWR points within its footprint is matched to the nearest free GWR point again, changed
+    # or not, as changed buildings can take or free the GWR points of unchanged buildings
+    unmatched = mapped_df.index[(mapped_df['match_method'] != 'within').values]
+    if (zone_changed or surroundings_gdf is not None) and config.gwr_mapper.nearest_distance > 0 and len(unmatched):
+        with report.stage('Matching buildings to nearest GWR points', rows_in=len(unmatched),
+                          unit='buildings') as stage:
+            # GWR points within surroundings buildings are not free either
+            zone_geometries = reprojected_zone_gdf[['Name', 'geometry']]
+            if surroundings_gdf is not None:
+                zone_geometries = pd.concat([zone_geometries, surroundings_geometries])
+            zone_geometries = zone_geometries.reset_index(drop=True)
+            nearest_df = match_nearest_gwr(zone_geometries, gwr_gdf, unmatched.values,
+                                           config.gwr_mapper.nearest_distance)
+            mapped_df = mapped_df.drop(unmatched)
+            if not nearest_df.empty:
+                nearest_df = reduce_building_properties(nearest_df).rename(
+                    columns={'federal_id': 'match_federal_id'}).assign(match_method='nearest')
+                mapped_df = pd.concat([mapped_df, nearest_df.set_index('Name')[mapped_columns]])
+            # Buildings left without a nearest GWR point are not matched
+            mapped_df = mapped_df.reindex(zone_gdf['Name'])
+            mapped_df['match_method'] = mapped_df['match_method'].fillna('none')
+            stage['rows_out'] = len(nearest_df)
+
+    # An error reading the construction standards is raised here, before any output is written
+    standard_definition_df = standard_definition.result()
+
+    with report.stage('Filling in missing data', rows_in=len(zone_gdf), unit='buildings') as stage:
+        properties_df = fill_missing_properties(mapped_df).reset_index()
+
+        # Record how each building was matched, buildings without a match get the filled in properties
+        match_counts = mapped_df['match_method'].value_counts()
+        logger.info('Buildings matched within footprint: {}, to nearest GWR point: {}, not matched: {}'.format(
+            match_counts.get('within', 0), match_counts.get('nearest', 0), match_counts.get('none', 0)))
+        matches_path = os.path.join(locator.scenario, 'gwr-mapper-matches.csv')
+        matches_df = mapped_df[MATCH_COLUMNS].astype({'match_federal_id': 'Int64'}).reset_index()
+        record_written(stage, matches_path, write_csv(matches_df, matches_path))
+
+        # properties_df.to_csv(r'C:\Users\Reynold Mok\Downloads\GWR Data\mappings.csv')
+
+        record_output(stage, properties_df)
+
+    with report.stage('Setting CEA building floors from GWR data', rows_in=len(zone_gdf), unit='buildings') as stage:
+        new_zone_gdf = zone_gdf.set_index('Name')
+        gwr_floors_df = properties_df[['Name', 'number_floors']].set_index('Name').rename(
+            columns={"number_floors": "floors_ag"})
+        new_zone_gdf.update(gwr_floors_df)
+        new_zone_gdf['height_ag'] = new_zone_gdf['floors_ag'] * 3
+        new_zone_gdf = new_zone_gdf.reset_index()
+        record_written(stage, zone_path, write_shapefile(new_zone_gdf, zone_path, zone_gdf))
+        record_output(stage, new_zone_gdf)
+
+    if surroundings_gdf is not None:
+        with report.stage('Setting CEA surroundings floors from GWR data', rows_in=len(surroundings_gdf),
+                          unit='buildings') as stage:
+            # Surroundings buildings without GWR floors are left as they are
+            gwr_floors = surroundings_properties_df.set_index('Name')['number_floors']
+            gwr_floors.index = gwr_floors.index.str[len(SURROUNDINGS_PREFIX):]
+            gwr_floors = gwr_floors[gwr_floors > 0].astype(int)
+            new_surroundings_gdf = surroundings_gdf.set_index(surroundings_gdf['Name'].astype(str))
+            new_surroundings_gdf.loc[gwr_floors.index, 'floors_ag'] = gwr_floors.values
+            new_surroundings_gdf.loc[gwr_floors.index, 'height_ag'] = gwr_floors.values * 3
+            new_surroundings_gdf = new_surroundings_gdf.reset_index(drop=True)
+            record_written(stage, surroundings_path,
+                           write_shapefile(new_surroundings_gdf, surroundings_path, surroundings_gdf))
+            stage['rows_out'] = len(gwr_floors)
+
+    with report.stage('Generating CEA building typology from GWR data', rows_in=len(zone_gdf),
+                      unit='buildings') as stage:
+        typology_df = generate_typology(properties_df, standard_definition_df,
+                                        config.gwr_mapper.construction_year_out_of_range)
+
+        typology_path = locator.get_building_typology()
+        if not os.path.exists(os.path.dirname(typology_path)):
+            os.makedirs(os.path.dirname(typology_path))
+        existing_typology_df = read_output(typology_path, dbf_to_dataframe)
+        record_written(stage, typology_path, write_dbf(typology_df, typology_path, existing_typology_df))
+        record_output(stage, typology_df)
+
+        # The archetypes of new or changed buildings are updated, as well as of every building whose typology changed,
+        # e.g. with its filled in properties, the construction standards or ``construction-year-out-of-range``
+        affected = ~zone_gdf['Name'].isin(unchanged).values
+        affected |= zone_gdf['Name'].isin(get_changed_rows(typology_df, existing_typology_df, 'Name')).values
+        affected = zone_gdf['Name'].values[affected]
+
+    if len(affected):
+        with report.stage('Run CEA `archetypes-mapper` with generated building typology', rows_in=len(affected),
+                          unit='buildings'):
+            mapper_flags = {'update_architecture_dbf': True,
+                            'update_air_conditioning_systems_dbf': True,
+                            'update_indoor_comfort_dbf': True,
+                            'update_internal_loads_dbf': True,
+                            'update_supply_systems_dbf': True,
+                            'update_schedule_operation_cea': True}
+            archetypes_mapper(locator, buildings=affected, **mapper_flags)
+
+    with report.stage('Update heating and hot water supply systems from GWR data', rows_in=len(zone_gdf),
+                      unit='buildings') as stage:
+        supply_systems_df = dbf_to_dataframe(locator.get_building_supply()).set_index('Name')
+        gwr_supply_systems_df = properties_df[['Name', 'heating_tech_code', 'hot_water_tech_code']].set_index(
+            'Name').rename(columns={"heating_tech_code": "type_hs", "hot_water_tech_code": "type_dhw"})
+        # Only update rows of affected buildings and rows that were reset by `archetypes-mapper`
+        current_supply_systems_df = supply_systems_df.loc[gwr_supply_systems_df.index, ['type_hs', 'type_dhw']]
+        outdated = current_supply_systems_df != gwr_supply_systems_df
+        outdated_buildings = gwr_supply_systems_df.index[outdated.any(axis=1).values]
+        bytes_written = 0
+        if len(outdated_buildings):
+            supply_systems_df.update(gwr_supply_systems_df.loc[outdated_buildings])
+            supply_systems_df = supply_systems_df.reset_index()
+            bytes_written = write_atomic(supply_systems_df, locator.get_building_supply(), dataframe_to_dbf)
+        record_written(stage, locator.get_building_supply(), bytes_written)
+        stage['rows_out'] = len(outdated_buildings)
+
+    # Saved only once all outputs are written, so that the buildings of a failed run are mapped again by the next run
+    write_cache(mapped_df.assign(fingerprint=fingerprints), state_path, mapping_version)
+
+    if config.gwr_mapper.run_report != 'none':
+        report.write(os.path.join(locator.scenario, 'gwr-mapper-report.{}'.format(config.gwr_mapper.run_report)))
+
+    return report
+
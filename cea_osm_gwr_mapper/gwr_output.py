@@ -0,0 +1,155 @@
+"""
+Writes the outputs of the GWR Mapper to the scenario. A file is only written if its values change, compared column by
+column with the current file, and is written to a temporary file first that then replaces the current file, so that an
+interrupted run does not leave a partly written file behind. A shapefile is made of several files that are replaced one
+after the other, so an interrupted run can leave a mix of old and new files, which the next run writes again.
+"""
+import glob
+import os
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+from cea.utilities.dbf import dataframe_to_dbf, dbf_to_dataframe
+
+from cea_osm_gwr_mapper.gwr_instrumentation import logger
+
+# Files making up a shapefile, the ``.shp`` is replaced last
+SHAPEFILE_EXTENSIONS = ['.shx', '.dbf', '.prj', '.cpg', '.shp']
+
+# Floats are written to DBF files with 15 decimals, so smaller differences are not changes
+FLOAT_RTOL = 1e-9
+FLOAT_ATOL = 1e-12
+
+
+def read_output(path, read):
+    """
+    Returns the current contents of ``path`` read with ``read``, or None if there is no file or it cannot be read.
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        return read(path)
+    except Exception as e:
+        # The file is replaced as a whole
+        logger.info('Unable to read {}: {}'.format(path, e))
+        return None
+
+
+def get_changed_columns(df, existing_df):
+    """
+    Returns the columns of ``df`` with values that differ from ``existing_df``, or all columns if the rows, columns or
+    coordinate reference system differ.
+    """
+    if existing_df is None or len(df) != len(existing_df) or set(df.columns) != set(existing_df.columns) \
+            or getattr(df, 'crs', None) != getattr(existing_df, 'crs', None):
+        return list(df.columns)
+
+    df = df.reset_index(drop=True)
+    existing_df = existing_df.reset_index(drop=True)
+    return [column for column in df.columns if not values_equal(df[column], existing_df[column])]
+
+
+def get_changed_rows(df, existing_df, key):
+    """
+    Returns the ``key`` values of the rows of ``df`` that are new or differ from the row with the same ``key`` in
+    ``existing_df``, or of all rows if the columns differ.
+    """
+    if existing_df is None or set(df.columns) != set(existing_df.columns):
+        return df[key].values
+
+    keys = df[key].values
+    changed = ~np.isin(keys, existing_df[key].values)
+    existing_df = existing_df.drop_duplicates(key).set_index(key).reindex(keys).reset_index()
+    df = df.reset_index(drop=True)
+    for column in df.columns.drop(key):
+        changed |= values_differ(df[column], existing_df[column])
+    return keys[changed]
+
+
+def values_equal(values, existing_values):
+    """
+    Returns whether the values of two columns are the same, see ``values_differ``.
+    """
+    return not values_differ(values, existing_values).any()
+
+
+def values_differ(values, existing_values):
+    """
+    Returns which values of two columns differ, comparing geometries topologically, numbers within the precision of the
+    output files and everything else as text.
+    """
+    if isinstance(values.dtype, gpd.array.GeometryDtype):
+        return ~gpd.GeoSeries(values).geom_equals(gpd.GeoSeries(existing_values)).values
+    if pd.api.types.is_numeric_dtype(values) and pd.api.types.is_numeric_dtype(existing_values):
+        return ~np.isclose(values.astype(float).values, existing_values.astype(float).values, rtol=FLOAT_RTOL,
+                           atol=FLOAT_ATOL, equal_nan=True)
+    return values.astype(str).values != existing_values.astype(str).values
+
+
+def write_atomic(df, path, write, extensions=None):
+    """
+    Writes ``df`` with ``write(df, path)`` to temporary files that then replace the files of ``path``. ``extensions``
+    are the extensions of all files that can make up ``path``, in the order they are replaced. Files of ``path`` that
+    the new write does not produce are removed. Returns the number of bytes written.
+    """
+    base, extension = os.path.splitext(path)
+    tmp_base = base + '.tmp'
+    # Remove the temporary files left behind by an interrupted write
+    for tmp_path in glob.glob(glob.escape(tmp_base) + '.*'):
+        os.remove(tmp_path)
+    write(df, tmp_base + extension)
+
+    bytes_written = 0
+    for file_extension in extensions or [extension]:
+        if os.path.exists(tmp_base + file_extension):
+            bytes_written += os.path.getsize(tmp_base + file_extension)
+            os.replace(tmp_base + file_extension, base + file_extension)
+        elif os.path.exists(base + file_extension):
+            os.remove(base + file_extension)
+    return bytes_written
+
+
+def write_output(df, path, write, existing_df, extensions=None):
+    """
+    Writes ``df`` to ``path`` with ``write`` unless its values are the same as ``existing_df``, the current contents of
+    ``path`` (None if there is no file). Returns the number of bytes written, 0 if the file is unchanged.
+    """
+    changed_columns = get_changed_columns(df, existing_df)
+    if not changed_columns:
+        logger.info('Unchanged, not written: {}'.format(path))
+        return 0
+
+    bytes_written = write_atomic(df, path, write, extensions)
+    logger.info('Wrote {} bytes to {} (changed columns: {})'.format(bytes_written, path, ', '.join(changed_columns)))
+    return bytes_written
+
+
+def write_shapefile(gdf, path, existing_gdf):
+    """
+    Writes ``gdf`` to the shapefile ``path`` if it differs from ``existing_gdf``. Returns the number of bytes written.
+    """
+    return write_output(gdf, path, to_shapefile, existing_gdf, SHAPEFILE_EXTENSIONS)
+
+
+def write_dbf(df, path, existing_df):
+    """
+    Writes ``df`` to the DBF file ``path`` if it differs from ``existing_df``. Returns the number of bytes written.
+    """
+    return write_output(df, path, dataframe_to_dbf, existing_df)
+
+
+def write_csv(df, path):
+    """
+    Writes ``df`` without its index to the CSV file ``path`` if it differs from its contents. Returns the number of
+    bytes written.
+    """
+    return write_output(df, path, to_csv, read_output(path, pd.read_csv))
+
+
+def to_shapefile(gdf, path):
+    gdf.to_file(path)
+
+
+def to_csv(df, path):
+    df.to_csv(path, index=False)
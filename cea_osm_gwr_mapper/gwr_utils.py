@@ -1,5 +1,13 @@
+from __future__ import print_function
+
+import hashlib
+
+import numpy as np
 import pandas as pd
 
+from cea_osm_gwr_mapper.gwr_cache import get_cache_path, get_cache_key, open_cache_writer, read_cache
+from cea_osm_gwr_mapper.gwr_instrumentation import logger
+
 LV95_PROJECTION = {'init': 'epsg:2056'}
 
 GWR_HEADERS = [
@@ -142,8 +150,155 @@ BUILDING_TYPE = {
     1278: "INDUSTRIAL",
 }
 
+# Compact dtypes of the GWR columns used by the mapper. GWR codes are parsed as float32 (they can be missing) and stored
+# as categoricals once the whole file is read, years and floors as uint16 once missing values are filled in. Only the
+# LV95 coordinates need float64 for their precision.
+GWR_DTYPES = {
+    'federal_id': np.int64,
+    'canton': 'category',
+    'district_number': np.float32,
+    'district_name': 'category',
+    'e_coordinate': np.float64,
+    'n_coordinate': np.float64,
+    'building_category': np.float32,
+    'building_class': np.float32,
+    'building_status': np.float32,
+    'construction_year': np.float32,
+    'building_area': np.float32,
+    'number_floors': np.float32,
+    'heating_tech_1': np.float32,
+    'heating_source_1': np.float32,
+    'hot_water_tech_1': np.float32,
+    'hot_water_source_1': np.float32,
+}
+PARSE_BYTES_PER_ROW = 1024  # Approximate peak memory used to parse a row of the GWR file when parsing in chunks
+
+GWR_CODE_COLUMNS = ['building_category', 'building_class', 'building_status', 'heating_tech_1', 'heating_source_1',
+                    'hot_water_tech_1', 'hot_water_source_1']
+
+ENERGY_HEAT_SOURCES = sorted(set(ENERGY_HEAT_SOURCE.values()) | {'None'})
+
+# FIXME: Implement missing supply types for heating and hot water e.g. Solar Thermal, Cogen, Heat Exchanger
+# CEA supply system of (technology, energy source) pairs, None matching any technology or energy source.
+# Later rules take precedence over earlier ones and pairs not matched by any rule are set to no supply system (AS0).
+SUPPLY_SYSTEM_RULES = [
+    ('None', None, 'AS0'),
+    ('Unknown', None, 'AS0'),  # Set unknown to None
+    ('Boiler', 'Oil', 'AS1'),
+    ('Boiler', 'Coal', 'AS2'),
+    ('Boiler', 'Gas', 'AS3'),
+    ('Resistance', None, 'AS4'),
+    ('Boiler', 'Wood', 'AS5'),
+    ('HeatPump', 'Ground', 'AS6'),
+    ('HeatPump', 'Air', 'AS7'),
+    ('HeatPump', 'Water', 'AS8'),
+    (None, 'DistrictHeating', 'AS9'),
+]
+
+
+def get_code_lookup(names, categories):
+    """
+    Returns an array mapping GWR codes to the index of their name in ``categories``, unknown codes mapping to 'None'.
+    """
+    lookup = np.full(max(names) + 1, categories.index('None'), dtype=np.int8)
+    for code, name in names.items():
+        lookup[code] = categories.index(name)
+    return lookup
+
+
+def get_supply_systems(technology_names, prefix):
+    """
+    Returns the lookup table of CEA supply systems (prefixed with ``prefix``) for every pair of technology and energy
+    source, built from ``SUPPLY_SYSTEM_RULES``.
+    """
+    technologies = sorted(set(technology_names.values()) | {'None'})
+    supply_systems = sorted({prefix + system for _, _, system in SUPPLY_SYSTEM_RULES})
 
-def read_gwr(gwr_path):
+    table = np.full((len(technologies), len(ENERGY_HEAT_SOURCES)), supply_systems.index(prefix + 'AS0'), dtype=np.int8)
+    for technology, source, system in SUPPLY_SYSTEM_RULES:
+        if technology not in technologies + [None] or source not in ENERGY_HEAT_SOURCES + [None]:
+            continue  # Rule can never match
+        rows = slice(None) if technology is None else technologies.index(technology)
+        columns = slice(None) if source is None else ENERGY_HEAT_SOURCES.index(source)
+        table[rows, columns] = supply_systems.index(prefix + system)
+
+    return {'technologies': technologies,
+            'technology_lookup': get_code_lookup(technology_names, technologies),
+            'supply_systems': supply_systems,
+            'table': table}
+
+
+ENERGY_HEAT_SOURCE_LOOKUP = get_code_lookup(ENERGY_HEAT_SOURCE, ENERGY_HEAT_SOURCES)
+HEATING_SUPPLY_SYSTEMS = get_supply_systems(HEATING_TECH, 'SUPPLY_HEATING_')
+HOT_WATER_SUPPLY_SYSTEMS = get_supply_systems(HOT_WATER_TECH, 'SUPPLY_HOTWATER_')
+
+
+def get_translation_hash():
+    """
+    Returns a hash of the tables translating GWR codes to CEA building types and supply systems.
+    """
+    tables = [BUILDING_TYPE, HEATING_TECH, HOT_WATER_TECH, ENERGY_HEAT_SOURCE, SUPPLY_SYSTEM_RULES]
+    return hashlib.sha1(repr(tables).encode('utf-8')).hexdigest()
+
+
+def read_gwr(gwr_path, bounds=None, margin=0.0, chunksize=None, cache='use', cache_dir=None):
+    """
+    Reads the GWR file, reusing the parsed data from the GWR cache if it is up to date.
+
+    :param gwr_path: Path to the tab-separated GWR export
+    :param bounds: Only keep properties within (minx, miny, maxx, maxy) in LV95 coordinates, keeps all if None
+    :param margin: Margin in meters added around ``bounds``
+    :param chunksize: Number of rows to parse at a time, parses the whole file at once if None
+    :param cache: ``use`` to read from the cache and build it on a miss, ``rebuild`` to always rebuild the cache and
+        ``bypass`` to parse the GWR file without touching the cache
+    :param cache_dir: Directory to store the cache in, defaults to next to the GWR file
+    """
+    if bounds is not None:
+        minx, miny, maxx, maxy = bounds
+        bounds = (minx - margin, miny - margin, maxx + margin, maxy + margin)
+
+    if cache == 'bypass':
+        return parse_gwr(gwr_path, bounds, chunksize)
+
+    cache_path = get_cache_path(gwr_path, cache_dir)
+    cache_key = get_cache_key(gwr_path)
+    if cache == 'use':
+        df = read_cache(cache_path, cache_key, bounds)
+        if df is not None:
+            logger.info('GWR cache hit: {}'.format(cache_path))
+            return df
+        logger.info('GWR cache miss: {}'.format(cache_path))
+    else:
+        logger.info('Rebuilding GWR cache: {}'.format(cache_path))
+
+    # The cache holds the whole register, so it is written chunk by chunk while only the properties within bounds are
+    # kept in memory
+    cache_writer = open_cache_writer(cache_path, cache_key)
+    try:
+        df = parse_gwr(gwr_path, bounds, chunksize, cache_writer)
+        cache_writer.close()
+    finally:
+        cache_writer.discard()
+    if cache_writer.error is not None:
+        logger.warning('Unable to write GWR cache: {}'.format(cache_writer.error))
+
+    return df
+
+
+def get_read_chunk_size(max_memory_mb):
+    """
+    Returns the number of rows of the GWR file to parse at a time to use at most a quarter of ``max_memory_mb`` MiB for
+    parsing.
+    """
+    return max(int(max_memory_mb * 1024 ** 2 / 4 / PARSE_BYTES_PER_ROW), 1000)
+
+
+def parse_gwr(gwr_path, bounds=None, chunksize=None, cache_writer=None):
+    """
+    Parses the GWR file. When ``chunksize`` is given, the file is parsed in chunks and properties outside ``bounds`` are
+    dropped chunk by chunk, so the whole register is never held in memory. All properties are appended to
+    ``cache_writer`` if given, before dropping those outside ``bounds``.
+    """
     filter_cols = [
         'canton',
         'district_number',
@@ -162,25 +317,72 @@ def read_gwr(gwr_path):
         'hot_water_source_1'
     ]
 
-    df = pd.read_csv(gwr_path, sep='\t', names=GWR_HEADERS, index_col=False).set_index('federal_id')[filter_cols]
+    reader = pd.read_csv(gwr_path, sep='\t', names=GWR_HEADERS, usecols=['federal_id'] + filter_cols,
+                         dtype=GWR_DTYPES, index_col=False, chunksize=chunksize)
+    chunks = reader if chunksize else [reader]
+
+    dfs = []
+    construction_years = []
+    number_floors = []
+    for df in chunks:
+        df = df.set_index('federal_id')[filter_cols]
+
+        # Drop properties without any coordinates
+        no_coords = df['e_coordinate'].isna() | df['n_coordinate'].isna()
+        df = df[~no_coords]
+
+        # Drop non-existing buildings
+        existing_buildings = df['building_status'] == 1004
+        df = df[existing_buildings]
 
-    # Drop properties without any coordinates
-    no_coords = df['e_coordinate'].isna() | df['n_coordinate'].isna()
-    df = df[~no_coords]
+        # Keep year and floors of all properties to fill in missing values with the median of the whole register
+        construction_years.append(df['construction_year'].to_numpy(copy=True))
+        number_floors.append(df['number_floors'].to_numpy(copy=True))
 
-    # Drop non-existing buildings
-    existing_buildings = df['building_status'] == 1004
-    df = df[existing_buildings]
+        if cache_writer is not None:
+            cache_writer.append(df.assign(**{column: to_code_categorical(df[column]) for column in GWR_CODE_COLUMNS}))
 
-    # Fill missing year with median
-    df['construction_year'] = df['construction_year'].fillna(df['construction_year'].median()).astype(int)
+        if bounds is not None:
+            df = filter_gwr_by_bounds(df, *bounds)
+        dfs.append(df)
 
-    # Fill missing floors with median
-    df['number_floors'] = df['number_floors'].fillna(df['number_floors'].median()).astype(int)
+    df = concat_gwr(dfs)
+    for column in GWR_CODE_COLUMNS:
+        df[column] = to_code_categorical(df[column])
 
+    # Fill missing year and floors with the median
+    for column, values in [('construction_year', construction_years), ('number_floors', number_floors)]:
+        values = pd.Series(np.concatenate(values))
+        median = values.median()
+        df[column] = df[column].fillna(median).astype(np.uint16)
+        if cache_writer is not None:
+            cache_writer.set_column(column, values.fillna(median).to_numpy(dtype=np.uint16))
+
+    return df
+
+
+def concat_gwr(gwr_dfs):
+    """
+    Concatenates GWR data parsed in chunks or read from several GWR files, keeping categorical columns categorical.
+    """
+    if len(gwr_dfs) == 1:
+        return gwr_dfs[0]
+    df = pd.concat(gwr_dfs)
+    for column in gwr_dfs[0].columns:
+        # Categories differ between chunks and files, so concatenating them falls back to objects
+        if isinstance(gwr_dfs[0][column].dtype, pd.CategoricalDtype):
+            df[column] = df[column].astype('category')
     return df
 
 
+def to_code_categorical(codes):
+    """
+    Returns the GWR ``codes`` parsed as floats as a categorical of uint16 codes.
+    """
+    categorical = pd.Categorical(codes)
+    return categorical.rename_categories(categorical.categories.astype(np.uint16))
+
+
 def filter_gwr_by_bounds(gwr_df, minx, miny, maxx, maxy):
     e_coords = gwr_df['e_coordinate'].values
     n_coords = gwr_df['n_coordinate'].values
@@ -190,69 +392,66 @@ def filter_gwr_by_bounds(gwr_df, minx, miny, maxx, maxy):
     return gwr_df[within_e & within_n]
 
 
-# FIXME: Implement missing supply types for heating and hot water e.g. Solar Thermal, Cogen, Heat Exchanger
 def gwr_to_cea_code(gwr_df):
     # Heating
-    gwr_df['heating_tech'] = gwr_df['heating_tech_1'].map(HEATING_TECH).fillna('None')
-    gwr_df['heating_source'] = gwr_df['heating_source_1'].map(ENERGY_HEAT_SOURCE).fillna('None')
-
-    no_heating = (gwr_df['heating_tech'] == 'None') | (gwr_df['heating_tech'] == 'Unknown')  # Set unknown to None
-    oil_boiler = (gwr_df['heating_tech'] == 'Boiler') & (gwr_df['heating_source'] == 'Oil')
-    coal_boiler = (gwr_df['heating_tech'] == 'Boiler') & (gwr_df['heating_source'] == 'Coal')
-    gas_boiler = (gwr_df['heating_tech'] == 'Boiler') & (gwr_df['heating_source'] == 'Gas')
-    electrical_boiler = gwr_df['heating_tech'] == 'Resistance'
-    wood_boiler = (gwr_df['heating_tech'] == 'Boiler') & (gwr_df['heating_source'] == 'Wood')
-    ground_heat_pump = (gwr_df['heating_tech'] == 'HeatPump') & (gwr_df['heating_source'] == 'Ground')
-    air_heat_pump = (gwr_df['heating_tech'] == 'HeatPump') & (gwr_df['heating_source'] == 'Air')
-    water_heat_pump = (gwr_df['heating_tech'] == 'HeatPump') & (gwr_df['heating_source'] == 'Water')
-    district_heating = gwr_df['heating_source'] == 'DistrictHeating'
-
-    gwr_df.loc[no_heating, 'heating_tech_code'] = "SUPPLY_HEATING_AS0"
-    gwr_df.loc[oil_boiler, 'heating_tech_code'] = "SUPPLY_HEATING_AS1"
-    gwr_df.loc[coal_boiler, 'heating_tech_code'] = "SUPPLY_HEATING_AS2"
-    gwr_df.loc[gas_boiler, 'heating_tech_code'] = "SUPPLY_HEATING_AS3"
-    gwr_df.loc[electrical_boiler, 'heating_tech_code'] = "SUPPLY_HEATING_AS4"
-    gwr_df.loc[wood_boiler, 'heating_tech_code'] = "SUPPLY_HEATING_AS5"
-    gwr_df.loc[ground_heat_pump, 'heating_tech_code'] = "SUPPLY_HEATING_AS6"
-    gwr_df.loc[air_heat_pump, 'heating_tech_code'] = "SUPPLY_HEATING_AS7"
-    gwr_df.loc[water_heat_pump, 'heating_tech_code'] = "SUPPLY_HEATING_AS8"
-    gwr_df.loc[district_heating, 'heating_tech_code'] = "SUPPLY_HEATING_AS9"
-
-    # Set everything else to no heating
-    gwr_df['heating_tech_code'] = gwr_df['heating_tech_code'].fillna("SUPPLY_HEATING_AS0")
+    heating_tech, heating_source, heating_tech_code = translate_supply_system(
+        gwr_df['heating_tech_1'], gwr_df['heating_source_1'], HEATING_SUPPLY_SYSTEMS)
+    gwr_df['heating_tech'] = heating_tech
+    gwr_df['heating_source'] = heating_source
+    gwr_df['heating_tech_code'] = heating_tech_code
 
     # Hot water
-    gwr_df['hot_water_tech'] = gwr_df['hot_water_tech_1'].map(HOT_WATER_TECH).fillna('None')
-    gwr_df['hot_water_source'] = gwr_df['hot_water_source_1'].map(ENERGY_HEAT_SOURCE).fillna('None')
-
-    no_hot_water = (gwr_df['hot_water_tech'] == 'None') | (gwr_df['hot_water_tech'] == 'Unknown')  # Set unknown to None
-    oil_boiler = (gwr_df['hot_water_tech'] == 'Boiler') & (gwr_df['hot_water_source'] == 'Oil')
-    coal_boiler = (gwr_df['hot_water_tech'] == 'Boiler') & (gwr_df['hot_water_source'] == 'Coal')
-    gas_boiler = (gwr_df['hot_water_tech'] == 'Boiler') & (gwr_df['hot_water_source'] == 'Gas')
-    electrical_boiler = gwr_df['hot_water_tech'] == 'Resistance'
-    wood_boiler = (gwr_df['hot_water_tech'] == 'Boiler') & (gwr_df['hot_water_source'] == 'Wood')
-    ground_heat_pump = (gwr_df['hot_water_tech'] == 'HeatPump') & (gwr_df['hot_water_source'] == 'Ground')
-    air_heat_pump = (gwr_df['hot_water_tech'] == 'HeatPump') & (gwr_df['hot_water_source'] == 'Air')
-    water_heat_pump = (gwr_df['hot_water_tech'] == 'HeatPump') & (gwr_df['hot_water_source'] == 'Water')
-    district_heating = gwr_df['hot_water_source'] == 'DistrictHeating'
-
-    gwr_df.loc[no_hot_water, 'hot_water_tech_code'] = "SUPPLY_HOTWATER_AS0"
-    gwr_df.loc[oil_boiler, 'hot_water_tech_code'] = "SUPPLY_HOTWATER_AS1"
-    gwr_df.loc[coal_boiler, 'hot_water_tech_code'] = "SUPPLY_HOTWATER_AS2"
-    gwr_df.loc[gas_boiler, 'hot_water_tech_code'] = "SUPPLY_HOTWATER_AS3"
-    gwr_df.loc[electrical_boiler, 'hot_water_tech_code'] = "SUPPLY_HOTWATER_AS4"
-    gwr_df.loc[wood_boiler, 'hot_water_tech_code'] = "SUPPLY_HOTWATER_AS5"
-    gwr_df.loc[ground_heat_pump, 'hot_water_tech_code'] = "SUPPLY_HOTWATER_AS6"
-    gwr_df.loc[air_heat_pump, 'hot_water_tech_code'] = "SUPPLY_HOTWATER_AS7"
-    gwr_df.loc[water_heat_pump, 'hot_water_tech_code'] = "SUPPLY_HOTWATER_AS8"
-    gwr_df.loc[district_heating, 'hot_water_tech_code'] = "SUPPLY_HOTWATER_AS9"
-
-    # Set everything else to no hot water
-    gwr_df['hot_water_tech_code'] = gwr_df['hot_water_tech_code'].fillna("SUPPLY_HOTWATER_AS0")
-
-    # Building type
-    building_type = gwr_df['building_class'].map(BUILDING_TYPE)
-    most_common_type = building_type.value_counts().idxmax()
-    gwr_df['building_type'] = building_type.fillna(most_common_type)  # Fill empty values with most common building type
+    hot_water_tech, hot_water_source, hot_water_tech_code = translate_supply_system(
+        gwr_df['hot_water_tech_1'], gwr_df['hot_water_source_1'], HOT_WATER_SUPPLY_SYSTEMS)
+    gwr_df['hot_water_tech'] = hot_water_tech
+    gwr_df['hot_water_source'] = hot_water_source
+    gwr_df['hot_water_tech_code'] = hot_water_tech_code
+
+    # Building type, unknown GWR building classes are filled in by ``fill_building_type``
+    gwr_df['building_type'] = gwr_df['building_class'].map(BUILDING_TYPE).astype(object).astype('category')
 
     return gwr_df
+
+
+def fill_building_type(gwr_df):
+    """
+    Returns ``gwr_df`` with the most common building type filled in for unknown GWR building classes, together with that
+    building type. The filled in building type is also kept in ``building_type_fill`` of the properties it was filled in
+    for.
+    """
+    building_type = gwr_df['building_type'].astype(object)
+    most_common_type = building_type.value_counts().idxmax()
+    unknown = building_type.isna().values
+    return gwr_df.assign(building_type=building_type.fillna(most_common_type).astype('category'),
+                         building_type_fill=np.where(unknown, most_common_type, None)), most_common_type
+
+
+def translate_supply_system(technology_codes, source_codes, supply_systems):
+    """
+    Translates GWR technology and energy source codes to categoricals of technology, energy source and CEA supply
+    system, looking up the supply system of all properties at once in the precomputed ``supply_systems`` table.
+    """
+    technologies = supply_systems['technologies']
+    technology = lookup_codes(technology_codes, supply_systems['technology_lookup'], technologies.index('None'))
+    source = lookup_codes(source_codes, ENERGY_HEAT_SOURCE_LOOKUP, ENERGY_HEAT_SOURCES.index('None'))
+    supply_system = supply_systems['table'][technology, source]
+
+    return (pd.Categorical.from_codes(technology, technologies),
+            pd.Categorical.from_codes(source, ENERGY_HEAT_SOURCES),
+            pd.Categorical.from_codes(supply_system, supply_systems['supply_systems']))
+
+
+def lookup_codes(codes, lookup, default):
+    """
+    Returns the values of ``lookup`` indexed by the GWR ``codes``, using ``default`` for missing or unknown codes.
+    """
+    if isinstance(codes.dtype, pd.CategoricalDtype):
+        # Look up the categories only, missing values (code -1) taking the default appended at the end
+        category_values = lookup_codes(pd.Series(codes.cat.categories), lookup, default)
+        return np.append(category_values, default).astype(lookup.dtype)[codes.cat.codes.values]
+
+    codes = pd.to_numeric(codes).fillna(-1).to_numpy().astype(np.int64)
+    known = (0 <= codes) & (codes < len(lookup))
+    out = np.full(len(codes), default, dtype=lookup.dtype)
+    out[known] = lookup[codes[known]]
+    return out